@@ -1,12 +1,18 @@
 from typing import Dict
-import networkx as nx
 import numpy as np
 from numpy.typing import ArrayLike
-from scipy.linalg import eigh
+from scipy import sparse
+from scipy.linalg import eigvalsh
+from scipy.sparse.linalg import eigsh
 from sklearn.cluster import SpectralClustering, DBSCAN
 from algorithms import CaseSimilarity
 from graph import NetworkEdgeList, CitationNetwork
 
+# Affinity matrices of at least this many cases get their leading eigenvalues from a sparse eigensolver
+SPARSE_EIGENSOLVER_MIN_SIZE = 256
+# optimal_num_clusters only looks for the largest eigenvalue drop among this many leading eigenvalues
+MAX_NUM_CLUSTERS = 64
+
 
 class CaseClustering:
     citation_network: CitationNetwork
@@ -17,10 +23,9 @@ class CaseClustering:
         self.similarity = CaseSimilarity(citation_network)
 
     def dbscan_cluster(self, opinion_ids: set, eps=0.94) -> Dict[int, set]:
-        sgraph = self.similarity.internal_similarity(opinion_ids)
-        slaplacian = nx.laplacian_matrix(sgraph).toarray()
-        slaplacian += 1
-        sdist = slaplacian * (1 - np.identity(slaplacian.shape[0]))
+        opinion_ids = list(opinion_ids)
+        sdist = 1 - self.similarity.internal_similarity(opinion_ids)
+        np.fill_diagonal(sdist, 0)
         labels = DBSCAN(eps=eps, min_samples=1, metric="precomputed").fit(sdist).labels_
         output = {}
         for c, l in zip(opinion_ids, labels):
@@ -30,8 +35,8 @@ class CaseClustering:
         return output
 
     def spectral_cluster(self, opinion_ids: set, num_clusters=None):
-        graph = self.similarity.internal_similarity(opinion_ids)
-        affinity_mat = nx.to_numpy_matrix(graph)
+        opinion_ids = list(opinion_ids)
+        affinity_mat = self.similarity.internal_similarity(opinion_ids)
         if num_clusters is None:
             num_clusters = self.optimal_num_clusters(affinity_mat)
 
@@ -54,7 +59,7 @@ class CaseClustering:
         See Section 3.1 of the above paper for discussion of this technique.
         """
         largest_drop, largest_drop_index = 0, 0
-        eigenvalues = sorted(eigh(affinity_mat)[0], reverse=True)
+        eigenvalues = self.leading_eigenvalues(affinity_mat, MAX_NUM_CLUSTERS + 1)
         for i in range(1, len(eigenvalues)):
             if (curr_drop := eigenvalues[i - 1] - eigenvalues[i]) > largest_drop:
                 largest_drop, largest_drop_index = curr_drop, i
@@ -63,3 +68,21 @@ class CaseClustering:
             ):  # Impose a baseline filter to avoid over-partitioning cases
                 break
         return largest_drop_index or 1
+
+    @staticmethod
+    def leading_eigenvalues(affinity_mat: ArrayLike, k: int) -> np.array:
+        """
+        The k largest eigenvalues of a symmetric affinity matrix, in descending order. For large matrices only
+        those are computed, by ARPACK on a sparse copy of the matrix, rather than a full eigendecomposition.
+        """
+        n = affinity_mat.shape[0]
+        if n < SPARSE_EIGENSOLVER_MIN_SIZE or k >= n - 1:
+            return np.sort(eigvalsh(np.asarray(affinity_mat)))[::-1][:k]
+        return np.sort(
+            eigsh(
+                sparse.csr_matrix(affinity_mat),
+                k=k,
+                which="LA",
+                return_eigenvectors=False,
+            )
+        )[::-1]
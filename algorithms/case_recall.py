@@ -1,9 +1,10 @@
 import dataclasses
-import random
-from numpy.random import choice
+import time
+import numpy as np
 from typing import Tuple, List
 
 from algorithms import CaseRecommendation
+from graph.ann_index import DEFAULT_NUM_PROBES
 from db.sqlalchemy.models import Court
 from graph import CitationNetwork
 
@@ -26,6 +27,16 @@ class OverallRecallResult:
     overall_top20: float
 
 
+@dataclasses.dataclass
+class AnnRecallResult:
+    num_queries: int
+    num_recommendations: int
+    num_probes: int
+    recall: float
+    exact_seconds_per_query: float
+    ann_seconds_per_query: float
+
+
 class CaseRecall:
     citation_network: CitationNetwork
 
@@ -40,46 +51,44 @@ class CaseRecall:
         num_trials: int,
         same_court: bool,
         strategy: CaseRecommendation.Strategy = CaseRecommendation.Strategy.RWALK,
+        seed: int = None,
     ):
+        # Case selection, held-out neighbors and the recommendation walks are all drawn from this generator, so a
+        # seeded run reproduces exactly.
+        rng = np.random.default_rng(seed)
+        edge_list = self.citation_network.network_edge_list
         if isinstance(cases, int):
             num_cases = cases
             cases = []
             while len(cases) < num_cases:
-                case = choice(self.citation_network.network_edge_list.edge_list)
-                case_metadata = self.citation_network.network_edge_list.node_metadata[
-                    case
-                ]
+                case_idx = rng.choice(edge_list.edge_list)
                 if (
-                    case_metadata.end - case_metadata.end_in_neighbors >= 5
+                    len(edge_list.out_neighbors(case_idx)) >= 5
                 ):  # Must have at least 5 outbound citations
-                    cases.append(case)
+                    cases.append(edge_list.opinion_id_of(case_idx))
         overall_top1 = 0
         overall_top5 = 0
         overall_top20 = 0
         recall_results = []
         for c in cases:
-            md = self.citation_network.network_edge_list.node_metadata[c]
-            out_neighbors = list(
-                self.citation_network.network_edge_list.edge_list[
-                    md.end_in_neighbors : md.end
-                ]
-            )
+            case_idx = edge_list.index_of(c)
+            case_year = edge_list.year_of(case_idx)
+            out_neighbors = [
+                int(op_id)
+                for op_id in edge_list.opinion_ids_of(edge_list.out_neighbors(case_idx))
+            ]
             top1 = 0
             top5 = 0
             top20 = 0
             for i in range(num_trials):
-                removed_idx = random.randrange(len(out_neighbors))
+                removed_idx = int(rng.integers(len(out_neighbors)))
                 out_neighbors[removed_idx], out_neighbors[-1] = (
                     out_neighbors[-1],
                     out_neighbors[removed_idx],
                 )
                 removed = out_neighbors.pop()
                 same_court = (
-                    (
-                        self.citation_network.network_edge_list.node_metadata[
-                            removed
-                        ].court,
-                    )
+                    (edge_list.court_of(edge_list.index_of(removed)),)
                     if same_court
                     else ()
                 )
@@ -90,7 +99,8 @@ class CaseRecall:
                         courts=frozenset(court + same_court),
                         ignore_opinion_ids=frozenset([c]),
                         strategy=strategy,
-                        before_year=md.year,
+                        before_year=case_year,
+                        seed=int(rng.integers(2**32)),
                     ).keys()
                 )
                 if removed in recommendations:
@@ -117,3 +127,57 @@ class CaseRecall:
         return OverallRecallResult(
             recall_results, num_trials, overall_top1, overall_top5, overall_top20
         )
+
+    def ann_recall(
+        self,
+        num_queries: int,
+        num_recommendations=20,
+        num_probes=DEFAULT_NUM_PROBES,
+        court: Tuple[Court] = (),
+        seed: int = None,
+    ) -> AnnRecallResult:
+        """
+        Measures how many of the exact n2v recommendations for random single-case queries the ANN index also
+        returns, and how long both searches take.
+        """
+        if self.citation_network.ann_index is None:
+            raise ValueError("No n2v ANN index has been built for this network.")
+        rng = np.random.default_rng(seed)
+        edge_list = self.citation_network.network_edge_list
+        query_nodes = rng.choice(
+            np.flatnonzero(self.citation_network.node_embeddings.has_vector),
+            num_queries,
+        )
+        exact_seconds, ann_seconds, num_found = 0.0, 0.0, 0
+        num_expected = 0
+        for opinion_id in edge_list.opinion_ids_of(query_nodes).tolist():
+            query_args = (
+                frozenset([opinion_id]),
+                num_recommendations,
+                frozenset(court),
+            )
+            start = time.perf_counter()
+            exact = self.recommendation.n2v(
+                *query_args, options={"use_ann_index": False}
+            )
+            exact_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            approximate = self.recommendation.n2v(
+                *query_args, options={"num_probes": num_probes}
+            )
+            ann_seconds += time.perf_counter() - start
+            num_found += len(exact.keys() & approximate.keys())
+            num_expected += len(exact)
+        recall = 100 * num_found / num_expected if num_expected else 100.0
+        print(
+            f"For {num_queries} queries with {num_probes} probes:\n\trecall@{num_recommendations}: {recall}%\n"
+            f"\texact: {1000 * exact_seconds / num_queries:.2f}ms/query\n\tANN: {1000 * ann_seconds / num_queries:.2f}ms/query"
+        )
+        return AnnRecallResult(
+            num_queries,
+            num_recommendations,
+            num_probes,
+            recall,
+            exact_seconds / num_queries,
+            ann_seconds / num_queries,
+        )
@@ -1,8 +1,17 @@
-from typing import Dict
-from math import sqrt, log
+import dataclasses
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+from math import log
+import numpy as np
 from graph import CitationNetwork
+from graph.ann_index import DEFAULT_NUM_PROBES
+from graph.network_edge_list import NetworkEdgeList, UNKNOWN_YEAR
+from graph.node_embeddings import DEFAULT_RESCORE_FACTOR
+from graph.walk_vector_store import WalkVectorStore
 from algorithms.random_walker import RandomWalker
-from algorithms.helpers import top_n
+from algorithms.helpers import top_n_array
+from utils.io import NETWORK_CACHE_PATH
 from utils.logger import Logger
 from db.sqlalchemy.models import Court
 from enum import Enum
@@ -10,22 +19,83 @@ from typing import Callable
 
 MAX_NUM_STEPS = 200_000
 MAX_WALK_LENGTH = 5
+MAX_WALK_BATCH_SIZE = 16_384  # How many random walks to advance at once
+# With early stopping the visit counts are checked between batches, so smaller batches stop closer to convergence
+EARLY_STOPPING_WALK_BATCH_SIZE = 2_048
 
+# Early stopping criterion of Eksombatchai et. al (2018): a walk from a query case stops once
+# NUM_VISITED_THRESHOLD candidates have been visited at least VISITED_FREQ_THRESHOLD times.
 VISITED_FREQ_THRESHOLD = 100
 NUM_VISITED_THRESHOLD = 25
 
 
+@dataclasses.dataclass
+class CaseWalk:
+    nodes: np.array
+    visit_counts: np.array
+    num_steps: int
+    stopped_early: bool
+    precomputed: bool = False
+
+
+# Per-process recommendation engine for the walk pool, set up once by _init_walk_worker. Workers memory-map the
+# network cache themselves, so every process shares the parent's CSR pages rather than receiving a pickled copy.
+_worker_recommendation: Optional["CaseRecommendation"] = None
+
+
+def _init_walk_worker(network_build_id: str):
+    global _worker_recommendation
+    try:
+        edge_list = NetworkEdgeList.load(NETWORK_CACHE_PATH)
+    except (OSError, ValueError, KeyError) as err:
+        Logger.error(f"Walk worker could not load the network cache: {err}")
+        return
+    if edge_list.build_id != network_build_id:
+        Logger.error(
+            f"Walk worker found network build {edge_list.build_id} instead of {network_build_id}"
+        )
+        return
+    _worker_recommendation = CaseRecommendation(
+        CitationNetwork(network_edge_list=edge_list)
+    )
+
+
+def _walk_visit_counts(walk_kwargs: dict) -> CaseWalk:
+    if _worker_recommendation is None:
+        raise ValueError("Walk worker has no network matching the query's network.")
+    return _worker_recommendation.walk_visit_counts(**walk_kwargs)
+
+
 class CaseRecommendation:
     citation_network: CitationNetwork
     random_walker: RandomWalker
+    walk_executor: Optional[ProcessPoolExecutor]
 
     class Strategy(str, Enum):
         N2V = "n2v"
         RWALK = "rwalk"
 
-    def __init__(self, citation_network: CitationNetwork):
+    def __init__(self, citation_network: CitationNetwork, num_walk_workers=1):
+        """
+        :param num_walk_workers: With more than one worker, the walks from each case of a multi-case rwalk query run
+        concurrently on a process pool. Workers memory-map the network cache, so the network must have been loaded
+        from it; otherwise (or if the cache has since been rebuilt) walks run in this process.
+        """
         self.citation_network = citation_network
         self.random_walker = RandomWalker(self.citation_network)
+        self.walk_executor = (
+            ProcessPoolExecutor(
+                num_walk_workers,
+                initializer=_init_walk_worker,
+                initargs=(citation_network.network_edge_list.build_id,),
+            )
+            if num_walk_workers > 1
+            else None
+        )
+
+    def shutdown(self):
+        if self.walk_executor is not None:
+            self.walk_executor.shutdown(wait=False)
 
     def recommendations(
         self,
@@ -48,37 +118,58 @@ class CaseRecommendation:
         options=None,
     ) -> Dict[int, float]:
         """
-        Recommendations powered by Node2Vec network embeddings
-        :param options:
+        Recommendations powered by Node2Vec network embeddings: the cases whose embeddings have the highest cosine
+        similarity to the mean embedding of the query cases.
+        :param options: Supports before_year, to only return cases decided in or before that year. If an ANN index
+        has been built, only the nodes in its num_probes lists closest to the query are scored, unless use_ann_index
+        is False. With quantized embeddings, the rescore_factor * num_recommendations best quantized matches are
+        rescored at full precision.
         :param opinion_ids:
         :param num_recommendations: The number of cases to return
         :param courts: Which courts to return cases from
         :return: A dictionary of the top num_recommendation opinion IDs and their relevance values
         """
         if options is None:
-            options = {}  # Currently not used but perhaps in the future
-        opinion_ids = list(map(str, opinion_ids))
-        # Hacky fix to ensure we have enough recommendations to filter out the non-matching courts
-        # Eventually we want to implement the KNN logic ourselves (it's fairly simple) so we don't have to do
-        # kludgey stuff like this.
-        gensim_topn = num_recommendations * 100
-        recs = [
-            (int(resource_id), float(relevance))
-            for resource_id, relevance in self.citation_network.n2v_model.most_similar(
-                positive=opinion_ids, topn=gensim_topn
+            options = {}
+        before_year = options.get("before_year", None)
+        use_ann_index = options.get("use_ann_index", True)
+        num_probes = options.get("num_probes", DEFAULT_NUM_PROBES)
+        rescore_factor = options.get("rescore_factor", DEFAULT_RESCORE_FACTOR)
+
+        embeddings = self.citation_network.node_embeddings
+        if embeddings is None:
+            raise ValueError("N2V model not found, cannot make n2v recommendations.")
+        edge_list = self.citation_network.network_edge_list
+        query_node_indices = edge_list.indices_of(opinion_ids)
+        query_node_indices = query_node_indices[query_node_indices != -1]
+        query = embeddings.query_vector(query_node_indices)
+        if query is None:
+            return {}
+        ann_index = self.citation_network.ann_index if use_ann_index else None
+        if ann_index is not None:
+            candidates = ann_index.candidates(
+                query,
+                num_recommendations,
+                num_probes=num_probes,
+                court_codes=edge_list.court_codes_of(courts) if courts else None,
+                candidate_filter=lambda nodes: self.candidate_mask(
+                    nodes, before_year=before_year
+                )
+                & ~np.isin(nodes, query_node_indices),
             )
-        ]
-        if courts:
-            recs = [
-                (resource_id, relevance)
-                for resource_id, relevance in recs
-                if self.citation_network.network_edge_list.node_metadata[
-                    resource_id
-                ].court
-                in courts
-            ]
-        # TODO: Add before_year support
-        return dict(recs[:num_recommendations])
+        else:
+            # Exact search over only the nodes that pass the filters, so a narrow filter never runs short of results.
+            candidate_mask = embeddings.has_vector & self.candidate_mask(
+                np.arange(edge_list.num_nodes), courts, before_year
+            )
+            candidate_mask[query_node_indices] = False
+            candidates = np.flatnonzero(candidate_mask)
+        candidates, similarities = embeddings.nearest(
+            query, candidates, num_recommendations, rescore_factor=rescore_factor
+        )
+        return top_n_array(
+            edge_list.opinion_ids_of(candidates), similarities, num_recommendations
+        )
 
     def rwalk(
         self,
@@ -93,107 +184,285 @@ class CaseRecommendation:
         max_num_steps = options.get("max_num_steps", MAX_NUM_STEPS)
         ignore_opinion_ids = options.get("ignore_opinion_ids", None)
         before_year = options.get("before_year", None)
+        early_stopping = options.get("early_stopping", True)
+        report_num_steps = options.get("report_num_steps", False)
+        seed = options.get("seed", None)
+        use_precomputed_walks = options.get("use_precomputed_walks", True)
 
-        query_case_weights = self.input_case_weights(opinion_ids)
-        overall_node_freq_dict = {}
-        for opinion_id, weight in query_case_weights.items():
-            curr_max_num_steps = int(weight * max_num_steps)
-            curr_freq_dict = self.recommendations_for_case(
-                int(opinion_id),
-                num_recommendations=None,
-                max_walk_length=max_walk_length,
-                max_num_steps=curr_max_num_steps,
-                ignore_opinion_ids=ignore_opinion_ids,
+        edge_list = self.citation_network.network_edge_list
+        query_node_indices = frozenset(
+            int(idx) for idx in edge_list.indices_of(opinion_ids) if idx != -1
+        )
+        ignore_node_indices = (
+            frozenset(
+                int(idx)
+                for idx in edge_list.indices_of(ignore_opinion_ids)
+                if idx != -1
             )
-            for node, freq in curr_freq_dict.items():
-                if node in opinion_ids:
-                    continue
-                if node not in overall_node_freq_dict:
-                    overall_node_freq_dict[node] = 0
-                overall_node_freq_dict[node] += sqrt(
-                    freq
-                )  # See Eq. 3 of Eksombatchai et. al (2018)
-        # want this to be done before filtering out years
+            if ignore_opinion_ids
+            else None
+        )
+        query_case_weights = sorted(self.input_case_weights(query_node_indices).items())
+        # Every query case gets its own random stream, so a seeded query walks identically serially or in parallel.
+        case_seeds = np.random.SeedSequence(seed).spawn(len(query_case_weights))
+        # Stored walks can't avoid ignored nodes and are truncated to their top nodes, which a court or year filter
+        # could leave too few of. Seeded queries walk too, so that their seed decides their results.
+        walk_vector_store = (
+            self.citation_network.walk_vector_store
+            if use_precomputed_walks
+            and not ignore_node_indices
+            and not courts
+            and not before_year
+            and seed is None
+            else None
+        )
+        if walk_vector_store is not None and (
+            walk_vector_store.max_walk_length != max_walk_length
+            or walk_vector_store.early_stopping != early_stopping
+        ):
+            walk_vector_store = None
+
+        case_walks: List[Optional[CaseWalk]] = [None] * len(query_case_weights)
+        walks_to_run = {}
+        for i, ((node_idx, weight), case_seed) in enumerate(
+            zip(query_case_weights, case_seeds)
+        ):
+            curr_max_num_steps = int(weight * max_num_steps)
+            if walk_vector_store is not None and walk_vector_store.has_vector(node_idx):
+                case_walks[i] = self.precomputed_walk(
+                    walk_vector_store, node_idx, curr_max_num_steps
+                )
+            else:
+                walks_to_run[i] = dict(
+                    node_idx=node_idx,
+                    ignore_node_indices=ignore_node_indices,
+                    max_walk_length=max_walk_length,
+                    max_num_steps=curr_max_num_steps,
+                    early_stopping=early_stopping,
+                    rng=np.random.default_rng(case_seed),
+                )
+        for i, case_walk in zip(
+            walks_to_run, self.__run_walks(list(walks_to_run.values()))
+        ):
+            case_walks[i] = case_walk
+        visited_nodes, visit_scores, num_steps_by_case = [], [], {}
+        for (node_idx, _), case_walk in zip(query_case_weights, case_walks):
+            visited_nodes.append(case_walk.nodes)
+            visit_scores.append(
+                np.sqrt(case_walk.visit_counts)
+            )  # See Eq. 3 of Eksombatchai et. al (2018)
+            num_steps_by_case[edge_list.opinion_id_of(node_idx)] = case_walk.num_steps
+        if not visited_nodes:
+            return ({}, num_steps_by_case) if report_num_steps else {}
+        candidates, candidate_positions = np.unique(
+            np.concatenate(visited_nodes), return_inverse=True
+        )
+        scores = np.bincount(candidate_positions, weights=np.concatenate(visit_scores))
+        keep = ~np.isin(
+            candidates, np.fromiter(query_node_indices, dtype=candidates.dtype)
+        ) & self.candidate_mask(candidates, courts, before_year)
+        top_n_recommendations = top_n_array(
+            edge_list.opinion_ids_of(candidates[keep]),
+            scores[keep],
+            num_recommendations,
+        )
+        if report_num_steps:
+            return top_n_recommendations, num_steps_by_case
+        return top_n_recommendations
+
+    def __run_walks(self, walks: List[dict]) -> List[CaseWalk]:
+        """
+        Runs walk_visit_counts with each of the given arguments, on the walk pool if there is more than one. Results
+        come back in order whichever worker finishes first, so the merged scores are deterministic.
+        """
+        if self.walk_executor is not None and len(walks) > 1:
+            try:
+                return list(self.walk_executor.map(_walk_visit_counts, walks))
+            except (BrokenProcessPool, ValueError) as err:
+                Logger.error(f"Walk workers failed, walking in this process: {err}")
+                self.walk_executor.shutdown(wait=False)
+                self.walk_executor = None
+        return [self.walk_visit_counts(**walk) for walk in walks]
+
+    def candidate_mask(
+        self, candidates: np.array, courts: frozenset[Court] = None, before_year=None
+    ) -> np.array:
+        """
+        Which of the given node indices pass the court and year filters of a query. Nodes with an unknown year
+        never pass a before_year filter.
+        """
+        edge_list = self.citation_network.network_edge_list
+        mask = np.ones(len(candidates), dtype=bool)
         if courts:
-            overall_node_freq_dict = {
-                k: v
-                for k, v in overall_node_freq_dict.items()
-                if self.citation_network.network_edge_list.node_metadata[k].court
-                in courts
-            }
+            mask &= np.isin(
+                edge_list.court[candidates], edge_list.court_codes_of(courts)
+            )
         if before_year:
-            overall_node_freq_dict = {
-                k: v
-                for k, v in overall_node_freq_dict.items()
-                if self.citation_network.network_edge_list.node_metadata[k].year
-                <= before_year
-            }
-        top_n_recommendations = top_n(overall_node_freq_dict, num_recommendations)
-        return top_n_recommendations
+            candidate_years = edge_list.year[candidates]
+            mask &= (candidate_years != UNKNOWN_YEAR) & (candidate_years <= before_year)
+        return mask
 
     def recommendations_for_case(
         self,
-        opinion_id,
+        node_idx,
         num_recommendations,
-        ignore_opinion_ids: frozenset = None,
+        ignore_node_indices: frozenset = None,
         max_walk_length=MAX_WALK_LENGTH,
         max_num_steps=MAX_NUM_STEPS,
-    ) -> Dict[str, float]:
+        early_stopping=True,
+        seed=None,
+    ) -> Dict[int, float]:
         """
         Random-walk recommendation algorithm to return relevant cases given a case ID. Heavily based on
         Eksombatchai et. al (2018)'s Pixie recommendation algorithm for Pinterest.
 
-        :param opinion_id: The opinion ID to get recommendations for (source for the random walks)
+        :param node_idx: The network node index of the opinion to get recommendations for (source for the random walks)
         :param num_recommendations: The number of cases to return
         :param max_walk_length: Maximum number of steps to perform in a single random walk
         :param max_num_steps: The upper bound of random-walk steps to execute while computing recommendations
-        :return: A dictionary of the top num_recommendation opinion IDs and their visit values
+        :param early_stopping: Whether to stop walking once enough candidates have been visited often enough
+        :param seed: Seed for the random walks, for reproducible recommendations
+        :return: A dictionary of the top num_recommendation node indices and their visit values
         """
-        node_freq_dict = {}
+        case_walk = self.walk_visit_counts(
+            node_idx,
+            ignore_node_indices=ignore_node_indices,
+            max_walk_length=max_walk_length,
+            max_num_steps=max_num_steps,
+            early_stopping=early_stopping,
+            rng=np.random.default_rng(seed),
+        )
+        return top_n_array(case_walk.nodes, case_walk.visit_counts, num_recommendations)
+
+    def walk_visit_counts(
+        self,
+        node_idx,
+        ignore_node_indices: frozenset = None,
+        max_walk_length=MAX_WALK_LENGTH,
+        max_num_steps=MAX_NUM_STEPS,
+        early_stopping=True,
+        rng: np.random.Generator = None,
+    ) -> CaseWalk:
+        """
+        Runs batches of random walks from a node until max_num_steps steps have been walked, and counts how often
+        each node was the destination of a walk. Walks that end back on the source node are discarded and don't
+        count towards the step budget, exactly as if the walks had been performed one at a time.
+
+        With early stopping, the counts are checked after every batch and walking stops as soon as
+        NUM_VISITED_THRESHOLD nodes have been visited at least VISITED_FREQ_THRESHOLD times.
+        """
+        nodes, visit_counts = np.empty(0, dtype="int32"), np.empty(0, dtype="int64")
+        if not self.__can_leave(node_idx, ignore_node_indices):
+            return CaseWalk(nodes, visit_counts, num_steps=0, stopped_early=False)
+        if rng is None:
+            rng = self.random_walker.rng
+        max_batch_size = (
+            EARLY_STOPPING_WALK_BATCH_SIZE if early_stopping else MAX_WALK_BATCH_SIZE
+        )
+        mean_walk_length = (max_walk_length + 1) / 2
         num_steps = 0
         while (
             num_steps < max_num_steps
         ):  # Keep a constant worst-case bound on execution time
-            random_walk_dest, walk_length = self.random_walker.random_walk(
-                opinion_id, max_walk_length=5, ignore_opinion_ids=ignore_opinion_ids
+            batch_size = min(
+                max_batch_size,
+                int((max_num_steps - num_steps) / mean_walk_length) + 1,
             )
-            if random_walk_dest == opinion_id:
-                continue
-            if random_walk_dest not in node_freq_dict:
-                node_freq_dict[random_walk_dest] = 0
-            node_freq_dict[random_walk_dest] += 1
-            num_steps += walk_length
-        return top_n(node_freq_dict, num_recommendations)
+            destinations, walk_lengths = self.random_walker.random_walks(
+                node_idx, batch_size, max_walk_length, ignore_node_indices, rng
+            )
+            away_from_source = destinations != node_idx
+            if not away_from_source.any():
+                continue  # A small batch can return to the source entirely, but some walk will leave eventually
+            destinations = destinations[away_from_source]
+            steps_after_walk = num_steps + np.cumsum(walk_lengths[away_from_source])
+            # Only keep walks up to and including the one that exhausts the step budget.
+            num_walks_taken = min(
+                len(destinations),
+                int(np.searchsorted(steps_after_walk, max_num_steps)) + 1,
+            )
+            nodes, visit_counts = self.__merge_visit_counts(
+                nodes, visit_counts, destinations[:num_walks_taken]
+            )
+            num_steps = int(steps_after_walk[num_walks_taken - 1])
+            if (
+                early_stopping
+                and np.count_nonzero(visit_counts >= VISITED_FREQ_THRESHOLD)
+                >= NUM_VISITED_THRESHOLD
+            ):
+                return CaseWalk(nodes, visit_counts, num_steps, stopped_early=True)
+        return CaseWalk(nodes, visit_counts, num_steps, stopped_early=False)
+
+    def __can_leave(self, node_idx, ignore_node_indices: frozenset = None) -> bool:
+        """Whether a walk from the node can end anywhere else: it has a neighbor other than itself that isn't ignored."""
+        neighbors = self.citation_network.network_edge_list.neighbors(node_idx)
+        leaves = neighbors != node_idx
+        if ignore_node_indices:
+            leaves &= ~np.isin(
+                neighbors, np.fromiter(ignore_node_indices, dtype=neighbors.dtype)
+            )
+        return bool(leaves.any())
 
-    def input_case_weights(self, opinion_ids) -> Dict[int, float]:
+    @staticmethod
+    def precomputed_walk(
+        walk_vector_store: WalkVectorStore, node_idx, max_num_steps=MAX_NUM_STEPS
+    ) -> CaseWalk:
         """
-        Given a set of opinion IDs in a query, give the probability distribution with which to visit them based on
-        their degree centralities.
+        Looks up the stored visit vector of a node instead of walking. Stored walks used the full step budget (or
+        stopped early), so when this query case gets a smaller budget its visit counts are scaled down to match.
+        """
+        nodes, visit_counts, num_steps = walk_vector_store.vector(node_idx)
+        if max_num_steps < num_steps:
+            visit_counts = visit_counts * (max_num_steps / num_steps)
+            num_steps = max_num_steps
+        return CaseWalk(
+            nodes, visit_counts, num_steps, stopped_early=False, precomputed=True
+        )
+
+    @staticmethod
+    def __merge_visit_counts(
+        nodes: np.array, visit_counts: np.array, destinations: np.array
+    ) -> (np.array, np.array):
+        batch_nodes, batch_counts = np.unique(destinations, return_counts=True)
+        if len(nodes) == 0:
+            return batch_nodes, batch_counts
+        merged_nodes, positions = np.unique(
+            np.concatenate((nodes, batch_nodes)), return_inverse=True
+        )
+        merged_counts = np.bincount(
+            positions, weights=np.concatenate((visit_counts, batch_counts))
+        ).astype("int64")
+        return merged_nodes, merged_counts
+
+    def input_case_weights(self, node_indices) -> Dict[int, float]:
+        """
+        Given a set of network node indices in a query, give the probability distribution with which to visit them
+        based on their degree centralities.
 
-        :param opinion_ids: A set of opinion IDs
-        :return: A dictionary with keys being the input case IDs and values being the relative weight to select them
-        to begin the random walk.
+        :param node_indices: A set of node indices
+        :return: A dictionary with keys being the input node indices and values being the relative weight to select
+        them to begin the random walk.
         """
         total_num_edges, max_degree = 0, 0
         node_degrees = {}
-        for op_id in opinion_ids:
-            node_metadata = self.citation_network.network_edge_list.node_metadata[op_id]
-            node_degrees[op_id] = node_metadata.length
-            total_num_edges += node_metadata.length
-            if node_metadata.length > max_degree:
-                max_degree = node_metadata.length
+        for node_idx in node_indices:
+            degree = self.citation_network.network_edge_list.degree(node_idx)
+            node_degrees[node_idx] = degree
+            total_num_edges += degree
+            if degree > max_degree:
+                max_degree = degree
         if total_num_edges == 0:
-            return {op_id: 0 for op_id in opinion_ids}
+            return {node_idx: 0 for node_idx in node_indices}
         denormalized_weights = {
-            op_id: self.denormalized_case_weight(
+            node_idx: self.denormalized_case_weight(
                 node_degree, max_degree, total_num_edges
             )
-            for op_id, node_degree in node_degrees.items()
+            for node_idx, node_degree in node_degrees.items()
         }
         denormalized_weight_sum = sum(denormalized_weights.values())
         normalized_weights = {
-            op_id: node_weight / denormalized_weight_sum
-            for op_id, node_weight in denormalized_weights.items()
+            node_idx: node_weight / denormalized_weight_sum
+            for node_idx, node_weight in denormalized_weights.items()
         }
         return normalized_weights
 
@@ -201,13 +470,12 @@ class CaseRecommendation:
         return (node_degree * (max_degree - log(node_degree))) / total_num_edges
 
     def average_year_of_cases(self, nodes: frozenset) -> float:
+        edge_list = self.citation_network.network_edge_list
         sum_years, num_nodes = 0, 0
-        for node in nodes:
-            if (
-                node_year := self.citation_network.network_edge_list.node_metadata[
-                    node
-                ].year
-            ) is not None:
+        for node_idx in edge_list.indices_of(nodes):
+            if node_idx == -1:
+                continue
+            if (node_year := edge_list.year_of(node_idx)) is not None:
                 sum_years += node_year
                 num_nodes += 1
         return sum_years / num_nodes
@@ -1,26 +1,102 @@
+from enum import Enum
+from typing import List
+
 from peewee import fn
-from db.peewee.helpers import ts_match
+from db.peewee.helpers import ts_match, trgm_word_match
 from db.peewee.models import Opinion, Cluster
+from graph.case_name_index import CaseNameIndex
 from string import whitespace
 
+# Fuzzy results are ranked by word similarity plus this much per tenfold increase in citation count
+FUZZY_CITATION_WEIGHT = 0.05
+
 
 class CaseSearch:
+    class Strategy(str, Enum):
+        DATABASE = "db"
+        INDEX = "index"
+        FUZZY = "fuzzy"
+
     @staticmethod
-    def search_cases(query, max_cases=25):
+    def search_cases(
+        query,
+        max_cases=25,
+        strategy: Strategy = Strategy.DATABASE,
+        case_name_index: CaseNameIndex = None,
+    ):
+        """
+        :param strategy: Where to search. The case name index must be given to search it; its results only have the
+        indexed columns (see search_index).
+        """
+        if strategy == CaseSearch.Strategy.INDEX:
+            if case_name_index is None:
+                raise ValueError("No case name index to search.")
+            return CaseSearch.search_index(case_name_index, query, max_cases)
+        if strategy == CaseSearch.Strategy.FUZZY:
+            return CaseSearch.search_fuzzy(query, max_cases)
         search_text = CaseSearch.prepare_query(query)
         return (
-            Opinion.select(
-                Opinion,
+            Opinion.select_with_cluster(
                 fn.ts_headline(
                     Cluster.case_display_name(), fn.to_tsquery(search_text)
                 ).alias("headline"),
             )
-            .join(Cluster)
             .where(ts_match(Cluster.searchable_case_name, fn.to_tsquery(search_text)))
             .order_by(Cluster.citation_count.desc())
             .limit(max_cases)
         )
 
+    @staticmethod
+    def search_fuzzy(query: str, max_cases=25):
+        """
+        Tolerates misspellings by matching the query against the trigrams of case names (using the pg_trgm GIN
+        index on cluster.case_name), ranking matches by word similarity and citation count.
+        """
+        similarity = fn.word_similarity(query, Cluster.case_name)
+        return (
+            Opinion.select_with_cluster(
+                # plainto_tsquery accepts any input (unlike to_tsquery), and highlights the correctly spelled words.
+                fn.ts_headline(
+                    Cluster.case_display_name(), fn.plainto_tsquery(query)
+                ).alias("headline"),
+            )
+            .where(trgm_word_match(Cluster.case_name, query))
+            .order_by(
+                (
+                    similarity
+                    + FUZZY_CITATION_WEIGHT
+                    * fn.log(fn.coalesce(Cluster.citation_count, 0) + 1)
+                ).desc()
+            )
+            .limit(max_cases)
+        )
+
+    @staticmethod
+    def search_index(
+        case_name_index: CaseNameIndex, query: str, max_cases=25
+    ) -> List[Opinion]:
+        """
+        Searches the in-process case name index. Results are unsaved models built from the indexed columns, so
+        columns that aren't indexed (such as the CourtListener URIs) are None.
+        """
+        results = []
+        for case in case_name_index.search(query, max_cases):
+            fields = case_name_index.case_fields(case)
+            opinion = Opinion(
+                resource_id=fields["opinion_id"],
+                cluster=Cluster(
+                    resource_id=fields["cluster_id"],
+                    case_name=fields["case_name"],
+                    reporter=fields["reporter"],
+                    court=fields["court"],
+                    citation_count=fields["citation_count"],
+                    year=fields["year"],
+                ),
+            )
+            opinion.headline = case_name_index.headline(case, query)
+            results.append(opinion)
+        return results
+
     @staticmethod
     def prepare_query(query: str):
         """For now, just makes the query conform to tsquery syntax and adds prefix matching to last word."""
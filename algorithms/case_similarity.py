@@ -1,17 +1,31 @@
-from functools import cache
-import networkx as nx
+import os
 import numpy as np
-from typing import Set, Dict
+from scipy import sparse
+from typing import Set, Dict, List, Tuple
 from db.peewee.models import Similarity, Opinion, Cluster
 from peewee import SQL, fn
 from graph import CitationNetwork
+from utils.cache import LruTtlCache, ResultCache
 
 
 class CaseSimilarity:
     citation_network: CitationNetwork
+    db_similarity_cache: ResultCache
 
-    def __init__(self, citation_network: CitationNetwork):
+    def __init__(
+        self, citation_network: CitationNetwork, db_similarity_cache: ResultCache = None
+    ):
+        """
+        :param db_similarity_cache: Where to keep db_case_similarity scores, defaulting to an in-process cache. Back
+        it with a DiskCache to share scores between processes.
+        """
         self.citation_network = citation_network
+        self.db_similarity_cache = db_similarity_cache or ResultCache(
+            LruTtlCache(
+                max_size=int(os.getenv("SIMILARITY_CACHE_SIZE") or 1024),
+                ttl=float(os.getenv("SIMILARITY_CACHE_TTL") or 3600),
+            )
+        )
 
     @staticmethod
     def jaccard_index(n1_neighbors: Set[str], n2_neighbors: Set[str]) -> float:
@@ -23,55 +37,175 @@ class CaseSimilarity:
             np.union1d(n1_neighbors, n2_neighbors)
         )
 
-    def most_similar_to_group(self, opinion_ids: set) -> Dict[str, float]:
-        opinion_neighbor_sets = [
-            set(self.citation_network.network.neighbors(opinion_id))
-            for opinion_id in opinion_ids
+    def most_similar_to_group(
+        self, opinion_ids: set, use_minhash_index=False
+    ) -> Dict[int, float]:
+        """
+        The average Jaccard similarity of cases' neighbor sets to the neighbor sets of the given cases. Only cases
+        sharing at least one neighbor with the group are returned, since all others have similarity 0.
+
+        With use_minhash_index (and a MinHash index built), only the cases in the same LSH bucket as one of the
+        given cases are scored, which misses some of the less similar cases in exchange for not touching every case
+        two hops away from the group. See minhash_recall for how many it misses.
+        """
+        edge_list = self.citation_network.network_edge_list
+        node_indices = edge_list.indices_of(opinion_ids)
+        node_indices = node_indices[node_indices != -1]
+        if len(node_indices) == 0:
+            return {}
+        minhash_index = (
+            self.citation_network.minhash_index if use_minhash_index else None
+        )
+        if minhash_index is not None:
+            candidates = minhash_index.candidates(node_indices)
+            similarities = self.jaccard_similarities(node_indices, candidates)
+        else:
+            candidates = np.arange(edge_list.num_nodes)
+            similarities = self.jaccard_similarities(node_indices)
+        group_similarities = np.asarray(similarities.sum(axis=0)).ravel() / len(
+            node_indices
+        )
+        group_similarities[np.isin(candidates, node_indices)] = 0
+        similar = np.flatnonzero(group_similarities)
+        return dict(
+            zip(
+                edge_list.opinion_ids_of(candidates[similar]).tolist(),
+                group_similarities[similar].tolist(),
+            )
+        )
+
+    def internal_similarity(self, opinion_ids: List[int]) -> np.array:
+        """
+        The pairwise Jaccard similarities of a group of cases' neighbor sets, in the order of the given IDs, with
+        zeros on the diagonal. Cases that aren't in the network have similarity 0 to every other case.
+        """
+        node_indices = self.citation_network.network_edge_list.indices_of(opinion_ids)
+        in_network = node_indices != -1
+        group_neighbors = self.citation_network.adjacency_matrix[
+            node_indices[in_network]
         ]
-        similarity_value_dict = {}
-        for node in self.citation_network.network.nodes:
-            if node in opinion_ids:
-                continue
-            other_node_edges = set(self.citation_network.network.neighbors(node))
-            similarity_value_dict[node] = sum(
-                self.jaccard_index(op_neighbors, other_node_edges)
-                for op_neighbors in opinion_neighbor_sets
-            ) / len(opinion_neighbor_sets)
-        return similarity_value_dict
+        intersections = (group_neighbors @ group_neighbors.T).toarray()
+        degrees = np.diff(group_neighbors.indptr)
+        unions = degrees[:, np.newaxis] + degrees[np.newaxis, :] - intersections
+        similarities = np.zeros((len(opinion_ids), len(opinion_ids)))
+        similarities[np.ix_(in_network, in_network)] = np.divide(
+            intersections, unions, out=np.zeros_like(intersections), where=unions > 0
+        )
+        np.fill_diagonal(similarities, 0)
+        return similarities
+
+    def most_similar_cases(
+        self, opinion_id, two_hop=False, use_minhash_index=False
+    ) -> Dict[int, float]:
+        """
+        The Jaccard similarity of a case's neighbor set to that of each case it cites or is cited by (leaving out
+        those with similarity 0). With two_hop, every case sharing a neighbor with it is scored instead, as by
+        most_similar_to_group, which can return many thousands of cases for a well-cited case.
+        """
+        if two_hop:
+            return self.most_similar_to_group({opinion_id}, use_minhash_index)
+        edge_list = self.citation_network.network_edge_list
+        node_idx = edge_list.index_of(opinion_id)
+        if node_idx is None:
+            return {}
+        similarities = self.neighbor_similarities(np.array([node_idx])).tocoo()
+        not_self = similarities.col != node_idx
+        return dict(
+            zip(
+                edge_list.opinion_ids_of(similarities.col[not_self]).tolist(),
+                similarities.data[not_self].tolist(),
+            )
+        )
 
-    def most_similar_to_group_npy(self, opinion_ids: set) -> Dict[str, float]:
-        pass
+    def minhash_recall(self, num_queries=100, top_n=10, seed=0) -> float:
+        """
+        The fraction of the top_n most similar cases (by most_similar_to_group) to randomly chosen cases that are
+        still found with the MinHash index, averaged over num_queries cases.
+        """
+        edge_list = self.citation_network.network_edge_list
+        rng = np.random.default_rng(seed)
+        recalls = []
+        for node_idx in rng.choice(
+            edge_list.num_nodes, min(num_queries, edge_list.num_nodes), replace=False
+        ):
+            opinion_ids = {int(edge_list.node_ids[node_idx])}
+            exact = self.most_similar_to_group(opinion_ids)
+            if not exact:
+                continue
+            approximate = self.most_similar_to_group(
+                opinion_ids, use_minhash_index=True
+            )
+            top = sorted(exact, key=exact.get, reverse=True)[:top_n]
+            recalls.append(sum(case in approximate for case in top) / len(top))
+        return float(np.mean(recalls)) if recalls else 1.0
 
-    def internal_similarity(self, opinion_ids: set) -> nx.Graph:
+    def neighbor_similarities(self, node_indices: np.array) -> sparse.csr_matrix:
         """
-        Returns the internal similarity relationships in a group of cases.
+        Like jaccard_similarities over every node, but only keeping the similarities of the given nodes (rows) to
+        their own neighbors, so each row has at most as many entries as its node has neighbors.
         """
-        neighbor_dict = {
-            oi: set(self.citation_network.network.neighbors(oi)) for oi in opinion_ids
-        }
-        output_graph = nx.complete_graph(opinion_ids)
+        return (
+            self.jaccard_similarities(node_indices)
+            .multiply(self.citation_network.adjacency_matrix[node_indices])
+            .tocsr()
+        )
 
-        for id_1, id_2 in output_graph.edges:
-            output_graph[id_1][id_2]["weight"] = self.jaccard_index(
-                neighbor_dict[id_1], neighbor_dict[id_2]
+    def jaccard_similarities(
+        self, node_indices: np.array, other_node_indices: np.array = None
+    ) -> sparse.csr_matrix:
+        """
+        Jaccard similarities between the neighbor sets of the given nodes (rows) and of the other nodes, or of every
+        node in the network (columns). Intersection sizes come from one sparse product of adjacency rows, so only
+        pairs of nodes that share a neighbor are ever touched.
+        """
+        adjacency_matrix = self.citation_network.adjacency_matrix
+        degrees = np.diff(adjacency_matrix.indptr)
+        if other_node_indices is None:
+            other_node_indices = np.arange(adjacency_matrix.shape[0])
+            other_neighbors_transposed = (
+                adjacency_matrix  # The adjacency matrix is symmetric
             )
-        return output_graph
+        else:
+            other_neighbors_transposed = adjacency_matrix[other_node_indices].T
+        intersections = (
+            adjacency_matrix[node_indices] @ other_neighbors_transposed
+        ).tocoo()
+        unions = (
+            degrees[node_indices[intersections.row]]
+            + degrees[other_node_indices[intersections.col]]
+            - intersections.data
+        )
+        return sparse.csr_matrix(
+            (intersections.data / unions, (intersections.row, intersections.col)),
+            shape=intersections.shape,
+        )
 
-    def most_similar_cases(self, opinion_id) -> Dict[str, float]:
-        opinion_neighbors = set(self.citation_network.network.neighbors(opinion_id))
-        similarity_value_dict = {}
-        for node in opinion_neighbors:
-            other_node_edges = set(self.citation_network.network.neighbors(node))
-            similarity_value_dict[node] = self.jaccard_index(
-                opinion_neighbors, other_node_edges
+    def db_case_similarity(
+        self, cases: frozenset, max_cases=25
+    ) -> List[Tuple[Opinion, float]]:
+        """Instead of the network approach, uses cached similarity indexes in the database
+        to calculate similarity with a SQL query. The aggregated scores are kept in db_similarity_cache, so repeat
+        queries only look up the resulting opinions (with their clusters) by resource ID."""
+        cases = tuple(sorted(map(int, cases)))
+        max_cases = int(max_cases)
+        scores = dict(
+            self.db_similarity_cache.get_or_compute(
+                (cases, max_cases),
+                lambda: self.db_similarity_scores(cases, max_cases),
             )
-        return similarity_value_dict
+        )
+        opinions = Opinion.select_with_cluster().where(
+            Opinion.resource_id << list(scores.keys())
+        )
+        return sorted(
+            ((opinion, scores[opinion.resource_id]) for opinion in opinions),
+            key=lambda row: row[1],
+            reverse=True,
+        )
 
     @staticmethod
-    @cache
-    def db_case_similarity(cases: frozenset, max_cases=25):
-        """Instead of the network approach, uses cached similarity indexes in the database
-        to calculate similarity with a SQL query."""
+    def db_similarity_scores(cases: tuple, max_cases=25) -> List[Tuple[int, float]]:
+        """The resource IDs of the max_cases opinions most similar to the given cases, with their average similarity."""
         similarity_alias = "average_similarity"
         query = (
             Similarity.select(
@@ -80,11 +214,11 @@ class CaseSimilarity:
                     similarity_alias
                 ),
             )
-            .join(Opinion, on=Similarity.opinion_b)
-            .join(Cluster)
             .where(Similarity.opinion_a << cases)
             .group_by(Similarity.opinion_b)
             .order_by(SQL(similarity_alias).desc())
             .limit(max_cases)
         )
-        return query
+        return [
+            (row.opinion_b_id, float(getattr(row, similarity_alias))) for row in query
+        ]
@@ -2,6 +2,7 @@ import heapq
 from collections import OrderedDict
 from math import inf
 from typing import Dict, TypeVar
+import numpy as np
 
 T = TypeVar("T")
 
@@ -18,3 +19,16 @@ def top_n(value_dict: Dict[T, float], n: int) -> Dict[T, float]:
     for nth_largest in heapq.nlargest(min(n, len(collection)), collection):
         top_n_items[nth_largest[1]] = nth_largest[0]  # Reconstruct the dict
     return top_n_items
+
+
+def top_n_array(keys: np.array, values: np.array, n: int) -> Dict[int, float]:
+    """Like top_n, but for parallel arrays of keys and values. Uses a partial sort, so it runs in
+    O(k + n log n) time for k entries."""
+    if n is not None and n != inf and n < len(values):
+        candidates = np.argpartition(-values, n)[:n]
+    else:
+        candidates = np.arange(len(values))
+    order = candidates[np.argsort(-values[candidates], kind="stable")]
+    return OrderedDict(
+        (key, value) for key, value in zip(keys[order].tolist(), values[order].tolist())
+    )
@@ -1,39 +1,95 @@
-from random import randrange
+import numpy as np
 from graph import CitationNetwork
 
+# How many times a walker that lands on an ignored node redraws before giving up and staying where it is
+MAX_IGNORED_NODE_RESAMPLES = 16
+
 
 class RandomWalker:
     citation_network: CitationNetwork
+    rng: np.random.Generator
 
-    def __init__(self, citation_network):
+    def __init__(self, citation_network, seed=None):
+        """
+        :param seed: Seeds the generator used by walks that aren't given a generator of their own
+        """
         self.citation_network = citation_network
+        self.rng = np.random.default_rng(seed)
 
     def random_walk(
-        self, source_node, max_walk_length, ignore_opinion_ids=None
-    ) -> (str, int):
+        self, source_node, max_walk_length, ignore_node_indices=None, rng=None
+    ) -> (int, int):
         """
         Performs a random walk from the specified source node for the specified number of steps.
 
-        :param source_node: The source node's identifier (opinion resource_id)
+        :param source_node: The source node's index in the network edge list
         :param max_walk_length: The number of steps to randomly walk from the node
-        :return: The destination node's identifier
-        """
-        walk_length = randrange(0, max_walk_length) + 1
-        curr_node = source_node
-        if ignore_opinion_ids:
-            for step in range(walk_length):
-                while (
-                    curr_node := self.random_neighbor_fast(curr_node)
-                ) in ignore_opinion_ids:
-                    pass
-        for step in range(walk_length):
-            curr_node = self.random_neighbor_fast(curr_node)
-        return curr_node, walk_length
-
-    def random_neighbor_fast(self, source_node):
-        node_info = self.citation_network.network_edge_list.node_metadata[source_node]
-        if node_info.start == node_info.end:
-            return source_node
-        return self.citation_network.network_edge_list.edge_list[
-            randrange(node_info.start, node_info.end)
-        ]
+        :param ignore_node_indices: Node indices the walk may not step onto
+        :param rng: The NumPy random generator to draw steps from, defaults to the walker's own
+        :return: The destination node's index and the length of the walk
+        """
+        destinations, walk_lengths = self.random_walks(
+            source_node, 1, max_walk_length, ignore_node_indices, rng
+        )
+        return int(destinations[0]), int(walk_lengths[0])
+
+    def random_walks(
+        self,
+        source_node,
+        num_walks,
+        max_walk_length,
+        ignore_node_indices=None,
+        rng: np.random.Generator = None,
+    ) -> (np.array, np.array):
+        """
+        Performs num_walks independent random walks from the source node at once. Each walk draws its length
+        uniformly from [1, max_walk_length] and all walks are advanced together, one vectorized step at a time.
+
+        :param source_node: The source node's index in the network edge list
+        :param num_walks: The number of walks to perform
+        :param max_walk_length: The maximum number of steps in a single walk
+        :param ignore_node_indices: Node indices the walks may not step onto
+        :param rng: The NumPy random generator to draw steps from, defaults to the walker's own
+        :return: Arrays of the destination node index and the length of each walk
+        """
+        if rng is None:
+            rng = self.rng
+        ignored = (
+            np.fromiter(ignore_node_indices, dtype="int32")
+            if ignore_node_indices
+            else None
+        )
+        walk_lengths = rng.integers(1, max_walk_length + 1, size=num_walks)
+        curr_nodes = np.full(num_walks, source_node, dtype="int32")
+        for step in range(max_walk_length):
+            walking = np.flatnonzero(walk_lengths > step)
+            curr_nodes[walking] = self.random_neighbors(
+                curr_nodes[walking], rng, ignored
+            )
+        return curr_nodes, walk_lengths
+
+    def random_neighbors(
+        self, nodes: np.array, rng: np.random.Generator, ignored: np.array = None
+    ) -> np.array:
+        """
+        Picks a uniformly random neighbor for each of the given nodes. Nodes without neighbors stay where they are,
+        as do nodes whose neighbors are (with overwhelming probability) all ignored.
+        """
+        edge_list = self.citation_network.network_edge_list
+        starts = edge_list.offsets[nodes]
+        degrees = edge_list.offsets[nodes + 1] - starts
+        next_nodes = nodes.copy()
+        # Only nodes with neighbors draw, since there is nothing to draw from (and no valid range) for the rest.
+        has_neighbors = degrees > 0
+        to_draw = has_neighbors
+        for _ in range(MAX_IGNORED_NODE_RESAMPLES):
+            next_nodes[to_draw] = edge_list.edge_list[
+                starts[to_draw] + rng.integers(0, degrees[to_draw])
+            ]
+            if ignored is None:
+                return next_nodes
+            to_draw = has_neighbors & np.isin(next_nodes, ignored)
+            if not to_draw.any():
+                return next_nodes
+        next_nodes[to_draw] = nodes[to_draw]
+        return next_nodes
@@ -1,7 +1,10 @@
+import os
+import threading
+import time
+from typing import Dict
 from flask import Flask, abort, request, jsonify
 from flask_cors import CORS
 from http import HTTPStatus
-from io import BufferedReader
 from playhouse.shortcuts import model_to_dict
 
 from algorithms import (
@@ -11,29 +14,120 @@ from algorithms import (
     CaseSimilarity,
     case_oyez_brief,
 )
-from db.peewee.models import Opinion, Cluster, DEFAULT_SERIALIZATION_ARGS
+from algorithms.helpers import top_n
+from db.peewee.models import Opinion, DEFAULT_SERIALIZATION_ARGS
 from db.peewee.helpers import model_list_to_json, model_list_to_dicts
-from extraction.pdf_engine import PdfEngine
-from extraction.citation_extractor import CitationExtractor
+from extraction.pdf_jobs import IN_MEMORY_STORE, JobStatus, PdfJobQueue
 from graph import CitationNetwork
+from graph.network_edge_list import NetworkEdgeList
+from utils.cache import DiskCache, LruTtlCache, ResultCache
+from utils.io import (
+    NETWORK_CACHE_PATH,
+    PDF_JOBS_PATH,
+    RECOMMENDATION_CACHE_PATH,
+    SIMILARITY_CACHE_PATH,
+)
 from utils.logger import Logger
 
+MAX_BATCH_SIZE = 500
+
 app = Flask(__name__)
 CORS(app)
 citation_network: CitationNetwork = None
 similarity: CaseSimilarity = None
 clustering: CaseClustering = None
 recommendation: CaseRecommendation = None
+recommendation_cache: ResultCache = None
+pdf_job_queue: PdfJobQueue = None
+default_search_strategy = CaseSearch.Strategy.DATABASE
+last_network_check = 0.0
+network_reload_lock = threading.Lock()
 
 
 @app.before_first_request
 def initialize_app():
-    global citation_network, similarity, clustering, recommendation
+    global citation_network, similarity, clustering, recommendation, recommendation_cache, pdf_job_queue, default_search_strategy
     citation_network = CitationNetwork.get_citation_network(enable_caching=True)
     Logger.info("Loaded citation network.")
-    similarity = CaseSimilarity(citation_network)
+    # Similarity scores come from the table exported from this network build, so they are namespaced the same way.
+    similarity = CaseSimilarity(
+        citation_network,
+        db_similarity_cache=ResultCache(
+            LruTtlCache(
+                max_size=int(os.getenv("SIMILARITY_CACHE_SIZE") or 1024),
+                ttl=float(os.getenv("SIMILARITY_CACHE_TTL") or 3600),
+            ),
+            DiskCache(
+                SIMILARITY_CACHE_PATH,
+                version=citation_network.network_edge_list.build_id,
+                ttl=float(os.getenv("SIMILARITY_CACHE_TTL") or 3600),
+            )
+            if os.getenv("SIMILARITY_DISK_CACHE")
+            else None,
+        ),
+    )
     clustering = CaseClustering(citation_network)
-    recommendation = CaseRecommendation(citation_network)
+    recommendation = CaseRecommendation(
+        citation_network,
+        num_walk_workers=int(os.getenv("RECOMMENDATION_WALK_WORKERS") or 1),
+    )
+    # Disk cache entries are namespaced by network build, so rebuilding the network cache invalidates them.
+    recommendation_cache = ResultCache(
+        LruTtlCache(
+            max_size=int(os.getenv("RECOMMENDATION_CACHE_SIZE") or 1024),
+            ttl=float(os.getenv("RECOMMENDATION_CACHE_TTL") or 3600),
+        ),
+        DiskCache(
+            RECOMMENDATION_CACHE_PATH,
+            version=citation_network.network_edge_list.build_id,
+            ttl=float(os.getenv("RECOMMENDATION_CACHE_TTL") or 3600),
+        )
+        if os.getenv("RECOMMENDATION_DISK_CACHE")
+        else None,
+    )
+    pdf_job_queue = PdfJobQueue(
+        IN_MEMORY_STORE if os.getenv("PDF_JOB_STORE_IN_MEMORY") else PDF_JOBS_PATH,
+        num_workers=int(os.getenv("PDF_JOB_WORKERS") or 1),
+        ttl=float(os.getenv("PDF_JOB_TTL") or 86400),
+        network_build_id=citation_network.network_edge_list.build_id,
+    )
+    # Index results lack the columns that aren't indexed, so /cases/search only uses the index by default if asked to.
+    if os.getenv("SEARCH_CASE_NAME_INDEX"):
+        default_search_strategy = CaseSearch.Strategy.INDEX
+
+
+@app.before_request
+def reload_rebuilt_network():
+    """
+    Everything initialize_app sets up (and every cached result) belongs to the network build it loaded, so when the
+    network cache is rebuilt, each worker reinitializes the app the next time it checks the cache's build ID, at most
+    every NETWORK_CHECK_INTERVAL seconds (never, if 0).
+    """
+    global last_network_check
+    check_interval = float(os.getenv("NETWORK_CHECK_INTERVAL") or 60)
+    if citation_network is None or check_interval <= 0:
+        return
+    with network_reload_lock:
+        if time.monotonic() - last_network_check < check_interval:
+            return
+        last_network_check = time.monotonic()
+        build_id = NetworkEdgeList.cached_build_id(NETWORK_CACHE_PATH)
+        if build_id is None or build_id == citation_network.network_edge_list.build_id:
+            return
+        Logger.info(f"Network cache was rebuilt as build {build_id}, reloading...")
+        recommendation.shutdown()
+        pdf_job_queue.shutdown()
+        initialize_app()
+
+
+def opinions_by_resource_id(resource_ids) -> Dict[int, Opinion]:
+    """Fetches opinions with their clusters in one query, keyed by resource ID."""
+    return {
+        opinion.resource_id: opinion
+        for opinion in Opinion.select_with_cluster().where(
+            Opinion.resource_id << list(resource_ids)
+        )
+    }
 
 
 @app.after_request
@@ -42,27 +136,80 @@ def configure_caching(response: Flask.response_class):
     return response
 
 
-# TODO: If necessary (because extraction and parsing is slow), we can implement this as a stateful background job.
 @app.route("/pdf/upload", methods=["POST"])
 def upload_pdf():
+    """
+    Queues a PDF for citation extraction. Poll the returned job, then fetch its result once it is done. A PDF that
+    was already extracted gets a job that is done already, with 200 rather than 202.
+    """
     file = request.files.get("file")
     if file is None:
         return "No file provided.", HTTPStatus.UNPROCESSABLE_ENTITY
-    pdf_text = PdfEngine(BufferedReader(file)).get_text()
-    citations = list(CitationExtractor(pdf_text).get_extracted_citations())
-    return model_list_to_json(citations, extra_attrs=["parentheticals"])
+    job = pdf_job_queue.submit(file.read())
+    if job["status"] == JobStatus.DONE:
+        return job, HTTPStatus.OK
+    return job, HTTPStatus.ACCEPTED
+
+
+@app.route("/pdf/jobs/<job_id>")
+def get_pdf_job(job_id: str):
+    if (job := pdf_job_queue.job(job_id)) is None:
+        abort(HTTPStatus.NOT_FOUND)
+    return job
+
+
+@app.route("/pdf/jobs/<job_id>/result")
+def get_pdf_job_result(job_id: str):
+    if (job := pdf_job_queue.job(job_id)) is None:
+        abort(HTTPStatus.NOT_FOUND)
+    if job["status"] == JobStatus.PENDING:
+        return job, HTTPStatus.ACCEPTED
+    if job["status"] == JobStatus.FAILED:
+        return job, HTTPStatus.UNPROCESSABLE_ENTITY
+    if (result := pdf_job_queue.result(job_id)) is None:
+        abort(HTTPStatus.NOT_FOUND)  # The result expired before the job did
+    return jsonify(result)
 
 
 # TODO: All of these /cases/ routes can be refactored into their own Flask blueprint
 @app.route("/cases/<int:resource_id>")
 def get_case(resource_id: int):
     try:
-        opinion = Opinion.get(resource_id=resource_id)
+        opinion = (
+            Opinion.select_with_cluster()
+            .where(Opinion.resource_id == resource_id)
+            .get()
+        )
         return model_to_dict(opinion, **DEFAULT_SERIALIZATION_ARGS)
     except Opinion.DoesNotExist:
         abort(HTTPStatus.NOT_FOUND)
 
 
+@app.route("/cases/batch")
+def get_cases_batch():
+    """Looks up several cases in one request, in the order given. IDs can be repeated or comma-separated."""
+    try:
+        resource_ids = [
+            int(resource_id)
+            for ids in request.args.getlist("ids")
+            for resource_id in ids.split(",")
+            if resource_id
+        ]
+    except ValueError:
+        return "Case IDs must be integers.", HTTPStatus.UNPROCESSABLE_ENTITY
+    if len(resource_ids) < 1:
+        return "You must provide at least one case ID.", HTTPStatus.UNPROCESSABLE_ENTITY
+    if len(resource_ids) > MAX_BATCH_SIZE:
+        return (
+            f"You can look up at most {MAX_BATCH_SIZE} cases at once.",
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+        )
+    opinions = opinions_by_resource_id(resource_ids)
+    return model_list_to_json(
+        [opinions[op_id] for op_id in resource_ids if op_id in opinions]
+    )
+
+
 @app.route("/cases/<int:resource_id>/html")
 def get_case_html(resource_id: int):
     try:
@@ -78,44 +225,116 @@ def get_case_html(resource_id: int):
 def get_similar_cases():
     case_resource_ids = request.args.getlist("cases")
     max_cases = request.args.get("max_cases") or 25
+    method = request.args.get("method") or "db"
     if len(case_resource_ids) < 1:
         return "You must provide at least one case ID.", HTTPStatus.UNPROCESSABLE_ENTITY
-    similar_case_query = similarity.db_case_similarity(
-        frozenset(case_resource_ids), max_cases
-    )
+    if method == "jaccard":
+        # Computes similarity to the group from the network directly rather than from the stored similarity table.
+        # The MinHash index is faster for well-cited cases but misses some similar cases, so it is opt-in.
+        use_minhash_index = request.args.get("minhash", "").lower() in ("1", "true")
+        similarities = top_n(
+            similarity.most_similar_to_group(
+                set(map(int, case_resource_ids)), use_minhash_index=use_minhash_index
+            ),
+            int(max_cases),
+        )
+        similar_cases = sorted(
+            opinions_by_resource_id(similarities.keys()).values(),
+            key=lambda op: similarities[op.resource_id],
+            reverse=True,
+        )
+        return model_list_to_json(similar_cases)
+    if method != "db":
+        return "Unknown similarity method.", HTTPStatus.UNPROCESSABLE_ENTITY
     similar_cases = [
-        similarity_record.opinion_b for similarity_record in similar_case_query
+        opinion
+        for opinion, _ in similarity.db_case_similarity(
+            frozenset(case_resource_ids), max_cases
+        )
     ]
     return model_list_to_json(similar_cases)
 
 
+@app.route("/cases/similar/cache")
+def get_similarity_cache_stats():
+    return similarity.db_similarity_cache.stats()
+
+
 @app.route("/cases/recommendations")
 def get_recommended_cases():
     case_resource_ids = frozenset(map(int, request.args.getlist("cases")))
     court_ids = frozenset(map(str, request.args.getlist("courts")))
     max_cases = int(request.args.get("max_cases") or 10)
+    before_year = request.args.get("before_year", type=int)
+    seed = request.args.get("seed", type=int)
     if len(case_resource_ids) < 1:
         return "You must provide at least one case ID.", HTTPStatus.UNPROCESSABLE_ENTITY
-    recommendations = recommendation.recommendations(
-        case_resource_ids, max_cases, courts=court_ids
+    try:
+        strategy = CaseRecommendation.Strategy(
+            request.args.get("strategy") or CaseRecommendation.Strategy.RWALK
+        )
+    except ValueError:
+        return "Unknown recommendation strategy.", HTTPStatus.UNPROCESSABLE_ENTITY
+    cache_key = (
+        tuple(sorted(case_resource_ids)),
+        tuple(sorted(court_ids)),
+        max_cases,
+        strategy.value,
+        before_year,
+        seed,
+        citation_network.network_edge_list.build_id,
+    )
+    recommendations = dict(
+        recommendation_cache.get_or_compute(
+            cache_key,
+            lambda: list(
+                recommendation.recommendations(
+                    case_resource_ids,
+                    max_cases,
+                    courts=court_ids,
+                    strategy=strategy,
+                    before_year=before_year,
+                    seed=seed,
+                ).items()
+            ),
+        )
     )
     recommended_opinions = sorted(
-        Opinion.select()
-        .join(Cluster)
-        .where(Opinion.resource_id << list(recommendations.keys())),
+        opinions_by_resource_id(recommendations.keys()).values(),
         key=lambda op: recommendations[op.resource_id],
         reverse=True,
     )
     return model_list_to_json(recommended_opinions)
 
 
+@app.route("/cases/recommendations/cache")
+def get_recommendation_cache_stats():
+    return recommendation_cache.stats()
+
+
 @app.route("/cases/search")
 def search():
     search_query = request.args.get("query")
-    max_cases = request.args.get("max_cases")
+    max_cases = int(request.args.get("max_cases") or 25)
     if search_query is None or len(search_query) == 0:
         return jsonify([])
-    search_results = CaseSearch.search_cases(search_query, max_cases=max_cases)
+    try:
+        strategy = (
+            CaseSearch.Strategy(request.args.get("strategy"))
+            if request.args.get("strategy")
+            else default_search_strategy
+        )
+        search_results = CaseSearch.search_cases(
+            search_query,
+            max_cases=max_cases,
+            strategy=strategy,
+            case_name_index=citation_network.case_name_index,
+        )
+    except ValueError:
+        return (
+            "Unknown or unavailable search strategy.",
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+        )
     return model_list_to_json(search_results, extra_attrs=["headline"])
 
 
@@ -135,8 +354,10 @@ def get_case_clusters():
     clusters = clustering.spectral_cluster(
         set(case_resource_ids), num_clusters=num_clusters
     )
+    opinions = opinions_by_resource_id(case_resource_ids)
     output_dict = {}
     for cluster_name, opinion_ids in clusters.items():
-        opinion_models = Opinion.select().where(Opinion.resource_id << opinion_ids)
-        output_dict[str(cluster_name)] = model_list_to_dicts(opinion_models)
+        output_dict[str(cluster_name)] = model_list_to_dicts(
+            [opinions[op_id] for op_id in opinion_ids if op_id in opinions]
+        )
     return output_dict
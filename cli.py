@@ -4,7 +4,10 @@ import click
 
 from algorithms.case_recall import CaseRecall
 from graph import CitationNetwork
-from algorithms import CaseSearch, CaseRecommendation
+from graph.ann_index import DEFAULT_NUM_PROBES
+from graph.minhash_index import DEFAULT_NUM_BANDS, DEFAULT_ROWS_PER_BAND
+from graph.node_embeddings import QUANTIZATIONS
+from algorithms import CaseSearch, CaseRecommendation, CaseSimilarity
 from api import app
 from db.sqlalchemy import get_session, select
 from db.sqlalchemy.models import Opinion, Court
@@ -13,8 +16,13 @@ from ingress.db_updater import DbUpdater
 from ingress.embeddings import EmbeddingTrainer
 from ingress.helpers import JURISDICTIONS
 from ingress.citation_context_scraper import CitationContextScraper
+from ingress.similarity_exporter import (
+    SimilarityExporter,
+    DEFAULT_TOP_K as DEFAULT_SIMILARITY_TOP_K,
+)
+from ingress.walk_vectors import WalkVectorPrecomputer, DEFAULT_TOP_K
 from utils.format import pretty_print_opinion
-from utils.io import N2V_MODEL_PATH, CITATION_LIST_CSV_PATH
+from utils.io import N2V_MODEL_PATH, CITATION_LIST_CSV_PATH, WALK_VECTORS_PATH
 
 
 @click.group()
@@ -118,6 +126,42 @@ def data_scrape_contexts(pool_size: int):
     CitationContextScraper(pool_size).scrape_contexts()
 
 
+@data.command(
+    name="store-similarity",
+    help="Compute neighbor Jaccard similarities between opinions and store them in the similarity table",
+)
+@click.option(
+    "-p",
+    "--pool-size",
+    type=int,
+    default=1,
+    help="Number of concurrent processes to compute similarities with",
+)
+@click.option(
+    "-k",
+    "--top-k",
+    type=int,
+    default=DEFAULT_SIMILARITY_TOP_K,
+    show_default=True,
+    help="Only store the K most similar opinions for each opinion (0 stores every nonzero similarity)",
+)
+@click.option(
+    "--two-hop",
+    is_flag=True,
+    help="Score every opinion sharing a citation neighbor with each opinion, not only its own neighbors",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue an interrupted export of the same network build with the same options after the last opinion "
+    "already in the similarity table, rather than clearing it and starting over.",
+)
+def data_store_similarity(pool_size: int, top_k: int, two_hop: bool, resume: bool):
+    SimilarityExporter(
+        top_k=top_k or None, two_hop=two_hop, pool_size=pool_size, resume=resume
+    ).export()
+
+
 @cli.group(help="Commands relating to network embedding")
 def embeddings():
     pass
@@ -144,6 +188,153 @@ def embeddings_train(model_path: str, csv_path: str):
     EmbeddingTrainer(model_path, csv_path).train()
 
 
+@embeddings.command(
+    name="store",
+    help="Write the trained embeddings to a memory-mapped store that loads in milliseconds.",
+)
+@click.option(
+    "-q",
+    "--quantization",
+    type=click.Choice(QUANTIZATIONS),
+    default="float32",
+    show_default=True,
+    help="Precision to store the vectors in. Quantized stores keep float32 vectors on disk to rescore matches with.",
+)
+def embeddings_store(quantization: str):
+    citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+    citation_network.build_embedding_store(quantization)
+
+
+@embeddings.command(
+    name="build-index",
+    help="Build the approximate nearest-neighbor index used for n2v recommendations.",
+)
+@click.option(
+    "-l",
+    "--num-lists",
+    type=int,
+    help="Number of k-means clusters in the index (defaults to the square root of the number of embedded cases)",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Seed for k-means training",
+)
+def embeddings_build_index(num_lists: Optional[int], seed: int):
+    citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+    citation_network.build_ann_index(num_lists=num_lists, seed=seed)
+
+
+@cli.group(help="Commands to manage the cached citation network")
+def network():
+    pass
+
+
+@network.command(
+    name="build",
+    help="Rebuild the memory-mapped citation network cache from the database.",
+)
+@click.option(
+    "--scotus-only/--no-scotus-only",
+    default=False,
+    show_default=True,
+    help="Whether to only include Supreme Court opinions in the network.",
+)
+def network_build(scotus_only: bool):
+    CitationNetwork.build_citation_network_cache(scotus_only=scotus_only)
+
+
+@network.command(
+    name="precompute-walks",
+    help="Precompute truncated random-walk visit vectors for every opinion in the cached network.",
+)
+@click.option(
+    "-k",
+    "--top-k",
+    default=DEFAULT_TOP_K,
+    show_default=True,
+    help="Number of most-visited opinions to store per opinion",
+)
+@click.option(
+    "-p",
+    "--pool-size",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of concurrent processes to walk with",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Seed for the random walks",
+)
+def network_precompute_walks(top_k: int, pool_size: int, seed: int):
+    WalkVectorPrecomputer(
+        WALK_VECTORS_PATH, top_k=top_k, pool_size=pool_size, seed=seed
+    ).precompute()
+
+
+@network.command(
+    name="build-minhash",
+    help="Build the MinHash LSH index used to find cases with similar citation neighborhoods, and report how many "
+    "of the most similar cases it finds compared to exact Jaccard similarity.",
+)
+@click.option(
+    "-b",
+    "--num-bands",
+    default=DEFAULT_NUM_BANDS,
+    show_default=True,
+    help="Number of LSH bands. More bands find more similar cases at the cost of more candidates to score.",
+)
+@click.option(
+    "-r",
+    "--rows-per-band",
+    default=DEFAULT_ROWS_PER_BAND,
+    show_default=True,
+    help="Number of MinHash values per band. More rows make candidates more similar, but find fewer of them.",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Seed for the MinHash functions",
+)
+@click.option(
+    "--recall-queries",
+    default=100,
+    show_default=True,
+    help="Number of random cases to check the index's recall of their 10 most similar cases on (0 skips the check)",
+)
+def network_build_minhash(
+    num_bands: int, rows_per_band: int, seed: int, recall_queries: int
+):
+    citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+    citation_network.build_minhash_index(
+        num_bands=num_bands, rows_per_band=rows_per_band, seed=seed
+    )
+    if recall_queries > 0:
+        recall = CaseSimilarity(citation_network).minhash_recall(
+            num_queries=recall_queries, top_n=10, seed=seed
+        )
+        click.echo(
+            f"The index finds {recall:.0%} of the 10 most similar cases found by exact Jaccard similarity."
+        )
+
+
+@network.command(
+    name="build-search-index",
+    help="Rebuild the in-process case name search index for the cached network.",
+)
+def network_build_search_index():
+    citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+    citation_network.build_case_name_index()
+
+
 @cli.group(help="Utilities to search and look up cases")
 def case():
     pass
@@ -167,9 +358,27 @@ def case_lookup(resource_id: int):
     show_default=True,
     help="Maximum number of case results",
 )
+@click.option(
+    "-s",
+    "--strategy",
+    type=click.Choice([s.value for s in CaseSearch.Strategy]),
+    default=CaseSearch.Strategy.DATABASE.value,
+    show_default=True,
+    help="Search the database's full-text index, the in-process case name index, or case name trigrams (tolerating misspellings).",
+)
 @click.argument("query", type=str)
-def case_search(query: str, num_cases: int):
-    search_results = CaseSearch.search_cases(query, max_cases=num_cases)
+def case_search(query: str, num_cases: int, strategy: str):
+    strategy = CaseSearch.Strategy(strategy)
+    case_name_index = None
+    if strategy == CaseSearch.Strategy.INDEX:
+        citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+        case_name_index = citation_network.case_name_index
+    search_results = CaseSearch.search_cases(
+        query,
+        max_cases=num_cases,
+        strategy=strategy,
+        case_name_index=case_name_index,
+    )
     output = f"{len(search_results)} result(s).\n\n"
     for op in search_results:
         output += f"{pretty_print_opinion(op)}\n\n"
@@ -201,19 +410,58 @@ def case_search(query: str, num_cases: int):
     default=[],
     help="Filter to a specific court id (can be provided multiple times)",
 )
+@click.option(
+    "--early-stopping/--no-early-stopping",
+    default=True,
+    show_default=True,
+    help="Whether rwalk stops walking from a case once its top candidates have converged",
+)
+@click.option(
+    "--report-steps/--no-report-steps",
+    default=False,
+    show_default=True,
+    help="Print how many random-walk steps were used for each bookmarked case (rwalk only)",
+)
+@click.option(
+    "-w",
+    "--walk-workers",
+    default=1,
+    show_default=True,
+    help="Number of processes to run the random walks from different bookmarks on (rwalk only)",
+)
+@click.option(
+    "--seed",
+    type=int,
+    help="Seed for the random walks, to make results reproducible",
+)
 def case_recommend(
     bookmarks: Tuple[int],
     num_cases: int,
     court: Tuple[Court],
     strategy: CaseRecommendation.Strategy,
+    early_stopping: bool,
+    report_steps: bool,
+    walk_workers: int,
+    seed: Optional[int],
 ):
     from db.peewee.models import Opinion, Cluster
 
     citation_network = CitationNetwork.get_citation_network(enable_caching=True)
-    recommendation = CaseRecommendation(citation_network)
+    recommendation = CaseRecommendation(citation_network, num_walk_workers=walk_workers)
+    report_steps = report_steps and strategy == CaseRecommendation.Strategy.RWALK
     recommendations = recommendation.recommendations(
-        frozenset(bookmarks), num_cases, courts=frozenset(court), strategy=strategy
+        frozenset(bookmarks),
+        num_cases,
+        courts=frozenset(court),
+        strategy=strategy,
+        early_stopping=early_stopping,
+        report_num_steps=report_steps,
+        seed=seed,
     )
+    if report_steps:
+        recommendations, num_steps_by_case = recommendations
+        for opinion_id, num_steps in num_steps_by_case.items():
+            click.echo(f"Walked {num_steps} steps from case {opinion_id}.")
     with get_session() as s:
         ro = sorted(
             Opinion.select()
@@ -257,19 +505,25 @@ def stats():
     show_default=True,
     help="Strategy for recommendation, can be rwalk or n2v.",
 )
+@click.option(
+    "--seed",
+    type=int,
+    help="Seed for trial sampling and random walks, to make results reproducible",
+)
 def cli_case_recall(
     cases: Tuple[int],
     court: Tuple[Court],
     num_trials: int,
     same_court: bool,
     strategy: CaseRecommendation.Strategy,
+    seed: Optional[int],
 ):
     if strategy == CaseRecommendation.Strategy.N2V:
         raise NotImplementedError("Cannot currently measure recall for n2v!")
     citation_network = CitationNetwork.get_citation_network(enable_caching=True)
     # TODO: Use what is returned to make output rather than printing inside of CaseRecall
     case_recall = CaseRecall(citation_network).case_recall(
-        cases, court, num_trials, same_court, strategy=strategy
+        cases, court, num_trials, same_court, strategy=strategy, seed=seed
     )
 
 
@@ -295,16 +549,67 @@ def cli_case_recall(
     default=True,
     help="whether to look for topN only in same court",
 )
+@click.option(
+    "--seed",
+    type=int,
+    help="Seed for case selection, trial sampling and random walks, to make results reproducible",
+)
 def cli_case_recall(
     num_cases: int,
     num_trials: int,
     same_court: bool,
     strategy: CaseRecommendation.Strategy,
+    seed: Optional[int],
 ):
     if strategy == CaseRecommendation.Strategy.N2V:
         raise NotImplementedError("Cannot currently measure recall for n2v!")
     citation_network = CitationNetwork.get_citation_network(enable_caching=True)
     # TODO: Use what is returned to make output rather than printing inside of CaseRecall
     case_recall = CaseRecall(citation_network).case_recall(
-        num_cases, (), num_trials, same_court, strategy=strategy
+        num_cases, (), num_trials, same_court, strategy=strategy, seed=seed
+    )
+
+
+@stats.command(
+    name="ann-recall",
+    help="Measure the recall of the n2v ANN index against exact search.",
+)
+@click.option(
+    "-q", "--num-queries", default=1000, help="Number of random cases to query."
+)
+@click.option(
+    "-n",
+    "--num-cases",
+    default=20,
+    help="Number of recommendations per query to compare.",
+)
+@click.option(
+    "-p",
+    "--num-probes",
+    default=DEFAULT_NUM_PROBES,
+    show_default=True,
+    help="Number of index lists to search per query.",
+)
+@click.option(
+    "-c",
+    "--court",
+    multiple=True,
+    default=[],
+    help="Filter results to a specific court id (can be provided multiple times)",
+)
+@click.option(
+    "--seed",
+    type=int,
+    help="Seed for query selection, to make results reproducible",
+)
+def cli_ann_recall(
+    num_queries: int,
+    num_cases: int,
+    num_probes: int,
+    court: Tuple[Court],
+    seed: Optional[int],
+):
+    citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+    CaseRecall(citation_network).ann_recall(
+        num_queries, num_cases, num_probes=num_probes, court=court, seed=seed
     )
@@ -1,5 +1,5 @@
 import os
-from typing import List
+from typing import List, Type
 from dotenv import load_dotenv
 from flask import jsonify
 from peewee import Expression, PostgresqlDatabase, Model
@@ -10,6 +10,12 @@ def ts_match(vector, query):
     return Expression(vector, "@@", query)
 
 
+def trgm_word_match(text, query):
+    """Whether some extent of text is similar to query, per pg_trgm's word_similarity_threshold."""
+    # psycopg2 treats % as a parameter placeholder, so the <% operator has to be escaped.
+    return Expression(query, "<%%", text)
+
+
 def connect_to_database():
     load_dotenv()
     if os.getenv("REMOTE_DB"):
@@ -46,3 +52,15 @@ def model_list_to_dicts(peewee_models: List[Model], **kwargs):
             peewee_models,
         )
     )
+
+
+def serialized_fields(model: Type[Model]) -> list:
+    """The fields of a model that are serialized by default, so queries for API responses can skip the others."""
+    from db.peewee.models import DEFAULT_SERIALIZATION_ARGS
+
+    excluded = DEFAULT_SERIALIZATION_ARGS["exclude"]
+    return [
+        field
+        for field in model._meta.sorted_fields
+        if not any(field is excluded_field for excluded_field in excluded)
+    ]
@@ -1,5 +1,6 @@
 from typing import List, Optional
 from peewee import IntegerField, TextField, ForeignKeyField
+from db.peewee.helpers import serialized_fields
 from db.peewee.models import BaseModel, Cluster
 
 
@@ -13,6 +14,16 @@ class Opinion(BaseModel):
     parentheticals: Optional[List[str]]
     contexts: Optional[List[str]]
 
+    @staticmethod
+    def select_with_cluster(*columns):
+        """
+        Selects opinions joined with their clusters, so that serializing them doesn't fetch each opinion's cluster
+        with a separate query. Fields that aren't serialized (like html_text) are not selected.
+        """
+        return Opinion.select(
+            *serialized_fields(Opinion), *serialized_fields(Cluster), *columns
+        ).join(Cluster)
+
     def ingest_parentheticals(self, parenthetical):
         """Someday we may not want to just append"""
         try:
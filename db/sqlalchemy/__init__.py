@@ -1,3 +1,3 @@
-from .helpers import get_session, ENGINE
+from .helpers import get_session, keyset_iterator, ENGINE
 from sqlalchemy import select
 from sqlalchemy.orm import joinedload
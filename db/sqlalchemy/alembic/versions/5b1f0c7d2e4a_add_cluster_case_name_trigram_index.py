@@ -0,0 +1,43 @@
+"""add cluster case name trigram index
+
+Revision ID: 5b1f0c7d2e4a
+Revises: d635179c9bf2
+Create Date: 2022-02-06 14:12:31.408215
+
+"""
+from alembic import op, context
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5b1f0c7d2e4a"
+down_revision = "d635179c9bf2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if context.get_x_argument(as_dictionary=True).get("data", None):
+        data_upgrade()
+    op.create_index(
+        "cluster_case_name_trgm_idx",
+        "cluster",
+        ["case_name"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"case_name": "gin_trgm_ops"},
+    )
+
+
+def downgrade():
+    if context.get_x_argument(as_dictionary=True).get("data", None):
+        data_downgrade()
+    op.drop_index("cluster_case_name_trgm_idx", table_name="cluster")
+
+
+def data_upgrade():
+    pass
+
+
+def data_downgrade():
+    pass
@@ -1,8 +1,13 @@
 import os
+from typing import Iterator
 
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, Row
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import ColumnElement, Select
+
+DEFAULT_KEYSET_BATCH_SIZE = 1000
 
 
 def get_db_url() -> str:
@@ -32,3 +37,37 @@ ENGINE = create_engine(get_db_url())
 # NOTE: Use sessions with a "with" block to ensure the session gets closed when done
 def get_session() -> Session:
     return Session(ENGINE)
+
+
+def keyset_iterator(
+    engine: Engine,
+    query: Select,
+    key_column: ColumnElement,
+    batch_size=DEFAULT_KEYSET_BATCH_SIZE,
+) -> Iterator[Row]:
+    """
+    Streams the rows of a query in order of key_column, which must be unique and the first column the query
+    selects, one batch at a time. Rows whose key is NULL can't be ordered after any other key, so they are left out. Each batch starts after the last key of the one before (key_column > last)
+    rather than at an OFFSET, so it is found with the column's index however deep into the table it is, and every
+    batch is read through a server-side cursor so that only a few rows (with any large text columns) are held in
+    memory at once.
+
+    Batches are read on their own connection, so callers can commit sessions of their own between rows.
+    """
+    query = query.where(key_column.is_not(None))
+    last_key = None
+    while True:
+        batch_query = query.order_by(key_column).limit(batch_size)
+        if last_key is not None:
+            batch_query = batch_query.where(key_column > last_key)
+        num_rows = 0
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                batch_query
+            )
+            for row in result:
+                num_rows += 1
+                last_key = row[0]
+                yield row
+        if num_rows < batch_size:
+            return
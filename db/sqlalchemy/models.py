@@ -140,6 +140,13 @@ class Cluster(Base):
             postgresql_using="gin",
             unique=False,
         ),
+        Index(
+            "cluster_case_name_trgm_idx",
+            "case_name",
+            postgresql_using="gin",
+            postgresql_ops={"case_name": "gin_trgm_ops"},
+            unique=False,
+        ),
     )
 
 
@@ -11,4 +11,4 @@ if __name__ == "__main__":
         frozenset(op_ids), max_cases=10
     )
     print(experiment_helpers.opinion_ids_to_names(recs.keys()))
-    print([sim.opinion_b.cluster.case_name for sim in sims])
+    print([opinion.cluster.case_name for opinion, _ in sims])
@@ -0,0 +1,57 @@
+import sys
+import time
+from typing import List, Tuple
+
+import eyecite
+from bs4 import BeautifulSoup
+from eyecite.tokenizers import AhocorasickTokenizer
+from sqlalchemy import select
+
+from db.sqlalchemy import get_session
+from db.sqlalchemy.models import Opinion
+from extraction.tokenizers import OneTimeTokenizer, get_tokenizer
+
+# Compares the per-document time to find citations with a freshly built tokenizer (as CitationExtractor used to)
+# against the shared, precompiled tokenizer. Usage: python -m experiments.tokenizer_benchmark [num_documents]
+
+
+def time_tokenizers(documents: List[str]) -> Tuple[float, float, float]:
+    """
+    Returns the seconds per document to find the citations of the documents with a new tokenizer per document, and
+    with the shared tokenizer, and the seconds it took to build the shared tokenizer.
+    """
+    start = time.perf_counter()
+    for document in documents:
+        eyecite.get_citations(
+            document, tokenizer=OneTimeTokenizer(AhocorasickTokenizer())
+        )
+    fresh_time = (time.perf_counter() - start) / len(documents)
+
+    start = time.perf_counter()
+    shared_tokenizer = get_tokenizer()
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for document in documents:
+        eyecite.get_citations(document, tokenizer=OneTimeTokenizer(shared_tokenizer))
+    shared_time = (time.perf_counter() - start) / len(documents)
+    return fresh_time, shared_time, build_time
+
+
+if __name__ == "__main__":
+    num_documents = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with get_session() as s:
+        documents = [
+            BeautifulSoup(html_text, features="lxml").text.replace("U. S.", "U.S.")
+            for html_text in s.execute(
+                select(Opinion.html_text)
+                .where(Opinion.html_text.is_not(None))
+                .limit(num_documents)
+            ).scalars()
+        ]
+    print(f"Tokenizing {len(documents)} documents...")
+    fresh_time, shared_time, build_time = time_tokenizers(documents)
+    print(f"New tokenizer per document: {fresh_time * 1000:.1f} ms/document")
+    print(
+        f"Shared {type(get_tokenizer()).__name__}: {shared_time * 1000:.1f} ms/document "
+        f"(plus {build_time * 1000:.0f} ms once to build it)"
+    )
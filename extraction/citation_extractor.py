@@ -1,10 +1,11 @@
-from typing import Iterable, List, cast
+from typing import Iterable, List, Optional, cast
 from db.sqlalchemy.models import Opinion, Cluster
+from extraction.tokenizers import OneTimeTokenizer
+from graph.case_name_index import CaseNameIndex
 from sqlalchemy import select
 from utils.format import format_reporter
 import eyecite
 from eyecite.models import Resource as EyeciteResource, CitationBase, CaseCitation
-from eyecite.tokenizers import Tokenizer, AhocorasickTokenizer
 import re
 from string import punctuation
 from string import ascii_lowercase
@@ -193,30 +194,24 @@ STOP_WORDS = set(
 LETTERS = set(ascii_lowercase)
 
 
-class OneTimeTokenizer(Tokenizer):
-    """
-    Wrap the CourtListener tokenizer to save tokenization results.
-    """
-
-    def __init__(self):
-        self.words = []
-        self.cit_toks = []
-
-    def tokenize(self, text: str):
-        if not self.words or self.cit_toks:
-            # some of the static methods in AhocorasickTokenizer don't like children.
-            self.words, self.cit_toks = AhocorasickTokenizer().tokenize(text)
-        return self.words, self.cit_toks
-
-
 class CitationExtractor:
     unstructured_text: str
+    case_name_index: Optional[CaseNameIndex]
 
-    def __init__(self, unstructured_text: str, sqlalchemy_session=None):
+    def __init__(
+        self,
+        unstructured_text: str,
+        sqlalchemy_session=None,
+        case_name_index: CaseNameIndex = None,
+    ):
+        """
+        :param case_name_index: If given, cited opinions are resolved from the index instead of the database
+        """
         # Allows eyecite to detect reporter citations when a whitespace exists between the letters of the abbreviation
         cleaned_text = unstructured_text.replace("U. S. ", "U.S. ")
         self.unstructured_text = cleaned_text
         self.sqlalchemy_session = sqlalchemy_session
+        self.case_name_index = case_name_index
 
     def get_citations(self) -> List[CitationBase]:
         self.tokenizer = OneTimeTokenizer()
@@ -266,8 +261,8 @@ class CitationExtractor:
                     contexts.append(
                         list(self.clean_contexts(self.tokenizer.words[start:stop]))
                     )
-            opinion.parentheticals.append(parentheticals)
-            opinion.contexts(contexts)
+            opinion.parentheticals = parentheticals
+            opinion.contexts = contexts
             extracted_citations.append(opinion)
         return extracted_citations
 
@@ -291,6 +286,8 @@ class CitationExtractor:
             ): i
             for i, res in enumerate(unique_resources)
         }
+        if self.case_name_index is not None:
+            return self.__indexed_opinions(list(reporters_of_cited_cases.keys()))
         stmt = (
             select(Opinion)
             .join(Cluster)
@@ -300,3 +297,26 @@ class CitationExtractor:
             self.sqlalchemy_session.execute(stmt).iterator,
             key=lambda op: reporters_of_cited_cases[op.cluster.reporter],
         )
+
+    def __indexed_opinions(self, reporters: List[str]) -> List[Opinion]:
+        """Transient (unsaved) opinions for the cases the index resolves the given reporters to, in order."""
+        opinions = []
+        for case in self.case_name_index.cases_of_reporters(reporters):
+            if case == -1:
+                continue
+            fields = self.case_name_index.case_fields(case)
+            opinions.append(
+                Opinion(
+                    resource_id=fields["opinion_id"],
+                    cluster_id=fields["cluster_id"],
+                    cluster=Cluster(
+                        resource_id=fields["cluster_id"],
+                        case_name=fields["case_name"],
+                        reporter=fields["reporter"],
+                        court=fields["court"],
+                        citation_count=fields["citation_count"],
+                        year=fields["year"],
+                    ),
+                )
+            )
+        return opinions
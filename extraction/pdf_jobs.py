@@ -0,0 +1,312 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+from io import BytesIO
+from typing import Dict, List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from db.sqlalchemy.helpers import get_db_url
+from db.sqlalchemy.models import Opinion
+from extraction.citation_extractor import CitationExtractor
+from extraction.pdf_engine import PdfEngine
+from extraction.tokenizers import get_tokenizer
+from graph.case_name_index import CaseNameIndex
+from utils.io import CASE_NAME_INDEX_PATH
+from utils.logger import Logger
+
+IN_MEMORY_STORE = ":memory:"
+# The columns of extracted opinions (and their clusters) in results, matching the API's serialized opinions
+SERIALIZED_OPINION_COLUMNS = ("id", "resource_id", "opinion_uri", "cluster_uri")
+SERIALIZED_CLUSTER_COLUMNS = (
+    "id",
+    "resource_id",
+    "case_name",
+    "reporter",
+    "court",
+    "citation_count",
+    "cluster_uri",
+    "docket_uri",
+    "year",
+    "time",
+)
+JOB_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pdf_job (
+    id TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    completed_at REAL
+);
+CREATE INDEX IF NOT EXISTS pdf_job_content_hash_idx ON pdf_job (content_hash);
+CREATE TABLE IF NOT EXISTS pdf_result (
+    content_hash TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pdf_claim (
+    content_hash TEXT PRIMARY KEY,
+    owner_pid INTEGER NOT NULL,
+    claimed_at REAL NOT NULL
+);
+"""
+INTERRUPTED_JOB_ERROR = "Extraction was interrupted before it finished."
+
+# Per-process database engine and case name index, set up by _init_worker (which also compiles the tokenizer) since
+# connections can't be shared with the parent process and the index is memory-mapped rather than pickled.
+_worker_engine = None
+_worker_case_name_index: Optional[CaseNameIndex] = None
+
+
+def _init_worker(network_build_id: Optional[str]):
+    global _worker_engine, _worker_case_name_index
+    _worker_engine = create_engine(get_db_url())
+    get_tokenizer()
+    if network_build_id is not None and os.path.exists(CASE_NAME_INDEX_PATH):
+        try:
+            _worker_case_name_index = CaseNameIndex.load(
+                CASE_NAME_INDEX_PATH, network_build_id=network_build_id
+            )
+        except (OSError, ValueError, KeyError) as err:
+            Logger.info(f"Resolving PDF citations from the database: {err}")
+
+
+def _extract_citations(pdf: bytes) -> List[Dict]:
+    pdf_text = PdfEngine(BytesIO(pdf)).get_text()
+    with Session(_worker_engine) as s:
+        return [
+            serialize_opinion(opinion, extra_attrs=["parentheticals"])
+            for opinion in CitationExtractor(
+                pdf_text, s, case_name_index=_worker_case_name_index
+            ).get_extracted_citations()
+        ]
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Running, as another user
+    return True
+
+
+def serialize_opinion(opinion: Opinion, extra_attrs: List[str] = ()) -> Dict:
+    output = {column: getattr(opinion, column) for column in SERIALIZED_OPINION_COLUMNS}
+    output["cluster"] = {
+        column: getattr(opinion.cluster, column)
+        for column in SERIALIZED_CLUSTER_COLUMNS
+    }
+    for attr in extra_attrs:
+        output[attr] = getattr(opinion, attr, None)
+    return output
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class PdfJobQueue:
+    """
+    Extracts the citations from uploaded PDFs in a pool of worker processes, so that requests only have to submit
+    a PDF and poll its job. Jobs and results are kept in a SQLite database: a file shared by every API process on
+    the machine, or an in-process database if path is IN_MEMORY_STORE.
+
+    Results are stored by the SHA-256 hash of the PDF, so a PDF that was already extracted (or is being
+    extracted, by any process sharing the database) is never extracted again. The process extracting a PDF holds
+    a claim on its hash in the database until it finishes; pending jobs whose claim belongs to a process that is no
+    longer running are marked failed. Jobs and results expire after ttl seconds.
+
+    Given the build ID of the cached network, workers resolve cited opinions from the case name index built
+    with it, so extraction makes no database queries.
+    """
+
+    path: str
+    ttl: float
+    num_workers: int
+    network_build_id: Optional[str]
+
+    def __init__(
+        self,
+        path=IN_MEMORY_STORE,
+        num_workers=1,
+        ttl=86400.0,
+        network_build_id: str = None,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.num_workers = num_workers
+        self.network_build_id = network_build_id
+        # Reentrant, since a future that is already done runs its callback right away, from inside submit()
+        self.__lock = threading.RLock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.row_factory = sqlite3.Row
+        with self.__lock, self.__connection:
+            self.__connection.executescript(JOB_STORE_SCHEMA)
+        self.__executor = self.__new_executor()
+        self.__fail_orphaned_jobs()
+
+    def submit(self, pdf: bytes) -> Dict:
+        """Queues a PDF for extraction, returning its job. Already extracted PDFs get a completed job."""
+        content_hash = hashlib.sha256(pdf).hexdigest()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "DELETE FROM pdf_job WHERE created_at < ?", (now - self.ttl,)
+            )
+            self.__connection.execute(
+                "DELETE FROM pdf_result WHERE created_at < ?", (now - self.ttl,)
+            )
+            is_cached = (
+                self.__connection.execute(
+                    "SELECT 1 FROM pdf_result WHERE content_hash = ?", (content_hash,)
+                ).fetchone()
+                is not None
+            )
+            if is_cached:
+                # Keeps the result alive at least as long as the new job that points to it.
+                self.__connection.execute(
+                    "UPDATE pdf_result SET created_at = ? WHERE content_hash = ?",
+                    (now, content_hash),
+                )
+            self.__connection.execute(
+                "INSERT INTO pdf_job (id, content_hash, status, created_at, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    content_hash,
+                    JobStatus.DONE.value if is_cached else JobStatus.PENDING.value,
+                    now,
+                    now if is_cached else None,
+                ),
+            )
+            # Claiming the hash fails if any process (including this one) is already extracting the PDF.
+            is_claimed = (
+                not is_cached
+                and self.__connection.execute(
+                    "INSERT OR IGNORE INTO pdf_claim (content_hash, owner_pid, claimed_at) VALUES (?, ?, ?)",
+                    (content_hash, os.getpid(), now),
+                ).rowcount
+                == 1
+            )
+        if is_claimed:
+            with self.__lock:
+                future = self.__submit_extraction(pdf)
+                future.add_done_callback(
+                    lambda f: self.__complete_jobs(content_hash, f)
+                )
+        return self.job(job_id)
+
+    def job(self, job_id: str) -> Optional[Dict]:
+        row = self.__job_row(job_id)
+        if row is not None and row["status"] == JobStatus.PENDING.value:
+            self.__fail_orphaned_jobs()
+            row = self.__job_row(job_id)
+        return dict(row) if row is not None else None
+
+    def __job_row(self, job_id: str) -> Optional[sqlite3.Row]:
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT id, status, error, created_at, completed_at FROM pdf_job WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+
+    def __fail_orphaned_jobs(self):
+        """
+        Fails the pending jobs of PDFs no process is extracting anymore: those whose claim belongs to a process
+        that has exited (e.g. an API worker that crashed or was restarted), or that have no claim at all.
+        """
+        now = time.time()
+        with self.__lock, self.__connection:
+            dead_claims = [
+                (row["content_hash"],)
+                for row in self.__connection.execute(
+                    "SELECT content_hash, owner_pid FROM pdf_claim"
+                )
+                if not _is_running(row["owner_pid"])
+            ]
+            self.__connection.executemany(
+                "DELETE FROM pdf_claim WHERE content_hash = ?", dead_claims
+            )
+            self.__connection.execute(
+                "UPDATE pdf_job SET status = ?, error = ?, completed_at = ? WHERE status = ? "
+                "AND content_hash NOT IN (SELECT content_hash FROM pdf_claim)",
+                (
+                    JobStatus.FAILED.value,
+                    INTERRUPTED_JOB_ERROR,
+                    now,
+                    JobStatus.PENDING.value,
+                ),
+            )
+
+    def result(self, job_id: str) -> Optional[List[Dict]]:
+        """The citations extracted by a completed job, or None if the job isn't done (or doesn't exist)."""
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT pdf_result.result FROM pdf_job JOIN pdf_result USING (content_hash) WHERE pdf_job.id = ?",
+                (job_id,),
+            ).fetchone()
+        return json.loads(row["result"]) if row is not None else None
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False)
+
+    def __new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            self.num_workers,
+            initializer=_init_worker,
+            initargs=(self.network_build_id,),
+        )
+
+    def __submit_extraction(self, pdf: bytes) -> Future:
+        try:
+            return self.__executor.submit(_extract_citations, pdf)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for running out of memory), which fails its jobs and breaks the whole pool.
+            Logger.error("PDF extraction pool is broken, starting a new one...")
+            self.__executor.shutdown(wait=False)
+            self.__executor = self.__new_executor()
+            return self.__executor.submit(_extract_citations, pdf)
+
+    def __complete_jobs(self, content_hash: str, future: Future):
+        now = time.time()
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "DELETE FROM pdf_claim WHERE content_hash = ? AND owner_pid = ?",
+                (content_hash, os.getpid()),
+            )
+            if (err := future.exception()) is not None:
+                Logger.error(
+                    f"Extracting citations from PDF {content_hash} failed: {err}"
+                )
+                self.__connection.execute(
+                    "UPDATE pdf_job SET status = ?, error = ?, completed_at = ? WHERE content_hash = ? AND status = ?",
+                    (
+                        JobStatus.FAILED.value,
+                        str(err),
+                        now,
+                        content_hash,
+                        JobStatus.PENDING.value,
+                    ),
+                )
+                return
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO pdf_result (content_hash, result, created_at) VALUES (?, ?, ?)",
+                (content_hash, json.dumps(future.result()), now),
+            )
+            self.__connection.execute(
+                "UPDATE pdf_job SET status = ?, completed_at = ? WHERE content_hash = ? AND status = ?",
+                (JobStatus.DONE.value, now, content_hash, JobStatus.PENDING.value),
+            )
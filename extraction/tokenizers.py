@@ -0,0 +1,67 @@
+import threading
+from typing import Optional
+
+from eyecite.tokenizers import Tokenizer, AhocorasickTokenizer, HyperscanTokenizer
+
+from utils.io import HYPERSCAN_TMP_PATH
+from utils.logger import Logger
+
+# The process-wide eyecite tokenizer, built on first use by get_tokenizer().
+_tokenizer: Optional[Tokenizer] = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer() -> Tokenizer:
+    """
+    The shared eyecite tokenizer of this process. eyecite tokenizers compile their patterns (a Hyperscan database
+    or an Aho-Corasick automaton) the first time they tokenize and keep them, so reusing one tokenizer makes that a
+    one-time cost. Hyperscan is used if it is installed, with its database cached under HYPERSCAN_TMP_PATH so that
+    other processes load it instead of compiling it again. Processes forked after the first call inherit the
+    compiled tokenizer.
+    """
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            _tokenizer = _build_tokenizer()
+        return _tokenizer
+
+
+def _build_tokenizer() -> Tokenizer:
+    try:
+        # noinspection PyPackageRequirements,PyUnresolvedReferences
+        import hyperscan
+
+        Logger.info("Initializing Hyperscan tokenizer...")
+        tokenizer = HyperscanTokenizer(cache_dir=HYPERSCAN_TMP_PATH)
+    except ImportError:
+        Logger.info("Hyperscan is not installed, using Ahocorasick tokenizer...")
+        tokenizer = AhocorasickTokenizer()
+    # Compile the patterns now rather than in the middle of the first document.
+    tokenizer.tokenize("")
+    return tokenizer
+
+
+class OneTimeTokenizer(Tokenizer):
+    """
+    Wrap the CourtListener tokenizer to save tokenization results, so that the words of the last tokenized text
+    can be read back (e.g. to slice the context around a citation) without tokenizing it again.
+    """
+
+    base_tokenizer: Tokenizer
+    text: Optional[str]
+
+    def __init__(self, base_tokenizer: Tokenizer = None):
+        """
+        :param base_tokenizer: The tokenizer to wrap, defaulting to the shared tokenizer of this process
+        """
+        self.base_tokenizer = base_tokenizer or get_tokenizer()
+        self.text = None
+        self.words = []
+        self.cit_toks = []
+
+    def tokenize(self, text: str):
+        if text != self.text:
+            # some of the static methods in AhocorasickTokenizer don't like children.
+            self.words, self.cit_toks = self.base_tokenizer.tokenize(text)
+            self.text = text
+        return self.words, self.cit_toks
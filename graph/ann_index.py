@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import time
+from typing import Callable, Optional
+
+import numpy as np
+
+from graph.network_edge_list import COURT_CODES, UNKNOWN_COURT_CODE
+from graph.node_embeddings import NodeEmbeddings
+from utils.logger import Logger
+
+ANN_INDEX_FORMAT_VERSION = 1
+ANN_INDEX_HEADER_FILE = "header.json"
+ANN_INDEX_ARRAYS = ("centroids", "list_offsets", "list_nodes")
+
+# The last slot of each list holds nodes with an unknown court
+NUM_COURT_SLOTS = len(COURT_CODES) + 1
+DEFAULT_NUM_PROBES = 16
+# k-means is trained on a sample of at most this many nodes per list
+KMEANS_SAMPLES_PER_LIST = 256
+KMEANS_ITERATIONS = 10
+ASSIGNMENT_CHUNK_SIZE = 65_536
+
+
+class IvfIndex:
+    """
+    Inverted-file approximate nearest-neighbor index over NodeEmbeddings. Nodes are clustered around num_lists
+    centroids by spherical k-means, and a query only scores the nodes in the lists whose centroids are most similar
+    to it.
+
+    Each list is further split by court, so that every court has its own sub-index sharing the same centroids: the
+    nodes of list l from the court with code c are list_nodes[list_offsets[s]:list_offsets[s + 1]] for
+    s = l * NUM_COURT_SLOTS + c. A list's slots are contiguous, so an unfiltered query reads each list in one slice.
+    """
+
+    network_build_id: str
+    model_mtime: float
+    centroids: np.array
+    list_offsets: np.array
+    list_nodes: np.array
+
+    @property
+    def num_lists(self) -> int:
+        return len(self.centroids)
+
+    def candidates(
+        self,
+        query: np.array,
+        min_candidates: int,
+        num_probes=DEFAULT_NUM_PROBES,
+        court_codes: np.array = None,
+        candidate_filter: Callable[[np.array], np.array] = None,
+    ) -> np.array:
+        """
+        The node indices in the num_probes lists closest to a unit query vector. If fewer than min_candidates of
+        them pass the court and candidate filters, further lists are probed (doubling the number each time), so
+        narrow filters trade speed for never running short of results.
+
+        :param court_codes: Only return nodes from these court codes
+        :param candidate_filter: Takes an array of node indices and returns a boolean mask of the ones to keep
+        """
+        probe_order = np.argsort(-(self.centroids @ query))
+        slots = (
+            np.where(
+                court_codes == UNKNOWN_COURT_CODE, NUM_COURT_SLOTS - 1, court_codes
+            )
+            if court_codes is not None
+            else None
+        )
+        candidates, num_probed = [], 0
+        num_candidates = 0
+        while num_probed < self.num_lists and (
+            num_probed < num_probes or num_candidates < min_candidates
+        ):
+            next_num_probed = min(self.num_lists, max(num_probes, 2 * num_probed))
+            lists = probe_order[num_probed:next_num_probed]
+            num_probed = next_num_probed
+            if slots is None:
+                starts = self.list_offsets[lists * NUM_COURT_SLOTS]
+                ends = self.list_offsets[(lists + 1) * NUM_COURT_SLOTS]
+            else:
+                list_slots = (
+                    lists[:, np.newaxis] * NUM_COURT_SLOTS + slots[np.newaxis, :]
+                ).ravel()
+                starts = self.list_offsets[list_slots]
+                ends = self.list_offsets[list_slots + 1]
+            probed = np.concatenate(
+                [self.list_nodes[start:end] for start, end in zip(starts, ends)]
+                or [np.empty(0, dtype="int32")]
+            )
+            if candidate_filter is not None:
+                probed = probed[candidate_filter(probed)]
+            candidates.append(probed)
+            num_candidates += len(probed)
+        return np.concatenate(candidates) if candidates else np.empty(0, dtype="int32")
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for array_name in ANN_INDEX_ARRAYS:
+            np.save(
+                os.path.join(tmp_path, f"{array_name}.npy"), getattr(self, array_name)
+            )
+        header = {
+            "format_version": ANN_INDEX_FORMAT_VERSION,
+            "network_build_id": self.network_build_id,
+            "model_mtime": self.model_mtime,
+            "courts": [court.value for court in COURT_CODES],
+            "created_at": int(time.time()),
+            "num_lists": self.num_lists,
+        }
+        with open(os.path.join(tmp_path, ANN_INDEX_HEADER_FILE), "w") as f:
+            json.dump(header, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(
+        path: str, network_build_id: str = None, model_mtime: float = None
+    ) -> IvfIndex:
+        """
+        Memory-maps an index written by save(). Node indices are only meaningful for the network build the index
+        was built against, and the centroids only for the model it was built from, so both are checked if given.
+        """
+        with open(os.path.join(path, ANN_INDEX_HEADER_FILE)) as f:
+            header = json.load(f)
+        if header.get("format_version") != ANN_INDEX_FORMAT_VERSION:
+            raise ValueError(
+                f"ANN index format version {header.get('format_version')} does not match "
+                f"expected version {ANN_INDEX_FORMAT_VERSION}"
+            )
+        if header["courts"] != [court.value for court in COURT_CODES]:
+            raise ValueError("ANN index court codes do not match the known courts")
+        if (
+            network_build_id is not None
+            and header["network_build_id"] != network_build_id
+        ):
+            raise ValueError(
+                f"ANN index was built for network build {header['network_build_id']}, not {network_build_id}"
+            )
+        if model_mtime is not None and header["model_mtime"] != model_mtime:
+            raise ValueError("ANN index was built from a different n2v model")
+        index = IvfIndex()
+        index.network_build_id = header["network_build_id"]
+        index.model_mtime = header["model_mtime"]
+        for array_name in ANN_INDEX_ARRAYS:
+            setattr(
+                index,
+                array_name,
+                np.load(os.path.join(path, f"{array_name}.npy"), mmap_mode="r"),
+            )
+        return index
+
+    @staticmethod
+    def build(
+        embeddings: NodeEmbeddings,
+        court: np.array,
+        network_build_id: str,
+        model_mtime: float,
+        num_lists: Optional[int] = None,
+        seed=0,
+    ) -> IvfIndex:
+        """
+        :param court: The court code of every node, as in NetworkEdgeList.court
+        :param num_lists: Number of k-means clusters, defaults to the square root of the number of embedded nodes
+        """
+        rng = np.random.default_rng(seed)
+        nodes = np.flatnonzero(embeddings.has_vector).astype("int32")
+        if num_lists is None:
+            num_lists = int(np.sqrt(len(nodes)))
+        # Without any vectors the index has no lists, so every query finds no candidates.
+        num_lists = min(max(1, num_lists), len(nodes))
+        Logger.info(f"Training {num_lists} IVF centroids on {len(nodes)} vectors...")
+        centroids = (
+            IvfIndex.__kmeans_centroids(embeddings, nodes, num_lists, rng)
+            if num_lists > 0
+            else np.zeros((0, embeddings.dimensions), dtype="float32")
+        )
+
+        Logger.info("Assigning nodes to IVF lists...")
+        assignments = np.concatenate(
+            [
+                IvfIndex.__nearest_centroids(
+                    embeddings.float_vectors(
+                        nodes[start : start + ASSIGNMENT_CHUNK_SIZE]
+                    ),
+                    centroids,
+                )
+                for start in range(0, len(nodes), ASSIGNMENT_CHUNK_SIZE)
+            ]
+            or [np.empty(0, dtype="int64")]
+        )
+        node_courts = np.asarray(court)[nodes].astype("int64")
+        slots = assignments * NUM_COURT_SLOTS + np.where(
+            node_courts == UNKNOWN_COURT_CODE, NUM_COURT_SLOTS - 1, node_courts
+        )
+        order = np.argsort(slots, kind="stable")
+        index = IvfIndex()
+        index.network_build_id = network_build_id
+        index.model_mtime = model_mtime
+        index.centroids = centroids.astype("float32")
+        index.list_nodes = nodes[order]
+        index.list_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(slots, minlength=num_lists * NUM_COURT_SLOTS)))
+        ).astype("int64")
+        return index
+
+    @staticmethod
+    def __kmeans_centroids(
+        embeddings: NodeEmbeddings,
+        nodes: np.array,
+        num_lists: int,
+        rng: np.random.Generator,
+    ) -> np.array:
+        """Spherical k-means centroids of a sample of the nodes' vectors, for 1 <= num_lists <= len(nodes)."""
+        sample = embeddings.float_vectors(
+            np.sort(
+                rng.choice(
+                    nodes,
+                    min(len(nodes), num_lists * KMEANS_SAMPLES_PER_LIST),
+                    replace=False,
+                )
+            )
+        )
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = IvfIndex.__nearest_centroids(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            norms = np.linalg.norm(sums, axis=1)
+            empty = norms == 0
+            # Re-seed empty clusters with random sample vectors rather than losing them
+            sums[empty] = sample[rng.choice(len(sample), np.count_nonzero(empty))]
+            norms[empty] = 1
+            centroids = sums / norms[:, np.newaxis]
+        return centroids
+
+    @staticmethod
+    def __nearest_centroids(vectors: np.array, centroids: np.array) -> np.array:
+        return np.concatenate(
+            [
+                np.argmax(
+                    vectors[start : start + ASSIGNMENT_CHUNK_SIZE] @ centroids.T, axis=1
+                )
+                for start in range(0, len(vectors), ASSIGNMENT_CHUNK_SIZE)
+            ]
+            or [np.empty(0, dtype="int64")]
+        )
@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import shutil
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from graph.network_edge_list import COURT_CODES, COURT_CODE_BY_NAME, UNKNOWN_COURT_CODE
+from utils.logger import Logger
+
+CASE_NAME_INDEX_FORMAT_VERSION = 2
+CASE_NAME_INDEX_HEADER_FILE = "header.json"
+CASE_NAME_INDEX_ARRAYS = (
+    "opinion_ids",
+    "cluster_ids",
+    "citation_counts",
+    "years",
+    "courts",
+    "case_name_offsets",
+    "case_name_bytes",
+    "reporter_offsets",
+    "reporter_bytes",
+    "vocabulary",
+    "vocabulary_offsets",
+    "posting_cases",
+    "case_token_offsets",
+    "case_token_ids",
+    "reporter_keys",
+    "reporter_cases",
+)
+
+TOKEN_PATTERN = re.compile(r"\w+")
+# Longer tokens are truncated, so they only have to match a query term on their first MAX_TOKEN_BYTES bytes
+MAX_TOKEN_BYTES = 32
+# Cases are checked against a query in blocks of at least this many when scanning in rank order
+SCAN_BLOCK_SIZE = 4_096
+HEADLINE_START, HEADLINE_STOP = "<b>", "</b>"
+
+# (opinion resource_id, cluster resource_id, case name, reporter, year, court, citation count)
+CaseNameRow = Tuple[int, int, str, Optional[str], Optional[int], Optional[str], int]
+
+
+def normalize(word: str) -> bytes:
+    return word.lower().encode("utf-8")[:MAX_TOKEN_BYTES]
+
+
+def tokenize(text: str) -> List[bytes]:
+    """The words of a case name or query, lowercased, UTF-8 encoded and truncated to MAX_TOKEN_BYTES."""
+    return [normalize(word) for word in TOKEN_PATTERN.findall(text)]
+
+
+class CaseNameIndex:
+    """
+    In-process typeahead index over the display names (case name, reporter and year) of every opinion's cluster,
+    answering the same queries as CaseSearch's tsquery search without a database round trip: every word of the
+    query must match a word of the display name, and the last word may match as a prefix unless the query ends
+    in whitespace.
+
+    Cases are numbered in rank order, by descending citation count, so the best matches of a query are always
+    the matching cases with the smallest numbers. Words are numbered by their position in the sorted vocabulary,
+    so the words starting with a prefix are a contiguous range of word numbers. The cases containing word w are
+    posting_cases[vocabulary_offsets[w]:vocabulary_offsets[w + 1]], sorted, and the words of case c are
+    case_token_ids[case_token_offsets[c]:case_token_offsets[c + 1]].
+
+    Rare query words are answered from their postings, while common ones (short prefixes in particular) scan
+    cases in rank order until enough matches are found, so neither has to touch every matching case.
+
+    The index also resolves reporter citations (e.g. "347 U.S. 483") to cases, without a database query:
+    reporter_keys holds every distinct reporter, sorted, and reporter_cases the best-ranked case with each one,
+    so that a citation resolves to the most cited of the cases sharing its reporter.
+    """
+
+    network_build_id: str
+    opinion_ids: np.array
+    cluster_ids: np.array
+    citation_counts: np.array
+    years: np.array
+    courts: np.array
+    case_name_offsets: np.array
+    case_name_bytes: np.array
+    reporter_offsets: np.array
+    reporter_bytes: np.array
+    vocabulary: np.array
+    vocabulary_offsets: np.array
+    posting_cases: np.array
+    case_token_offsets: np.array
+    case_token_ids: np.array
+    reporter_keys: np.array
+    reporter_cases: np.array
+
+    @property
+    def num_cases(self) -> int:
+        return len(self.opinion_ids)
+
+    def search(self, query: str, max_cases=25) -> np.array:
+        """The numbers of the best max_cases cases matching a query, in rank order."""
+        token_ranges = self.__token_ranges(query)
+        if not token_ranges or any(lo == hi for lo, hi in token_ranges):
+            return np.empty(0, dtype="int64")
+        num_postings = [
+            self.vocabulary_offsets[hi] - self.vocabulary_offsets[lo]
+            for lo, hi in token_ranges
+        ]
+        rarest = int(np.argmin(num_postings))
+        # Reading the rarest word's postings costs about num_postings, while scanning cases in rank order takes
+        # about max_cases * num_cases / num_postings cases to find max_cases matches.
+        if num_postings[rarest] ** 2 <= max_cases * self.num_cases:
+            lo, hi = token_ranges[rarest]
+            candidates = np.unique(
+                self.posting_cases[
+                    self.vocabulary_offsets[lo] : self.vocabulary_offsets[hi]
+                ]
+            )
+            return candidates[self.__matches(candidates, token_ranges)][:max_cases]
+        matches, num_matches, start = [], 0, 0
+        block_size = SCAN_BLOCK_SIZE
+        while start < self.num_cases and num_matches < max_cases:
+            block = np.arange(start, min(start + block_size, self.num_cases))
+            block_matches = block[self.__matches(block, token_ranges)]
+            matches.append(block_matches)
+            num_matches += len(block_matches)
+            start += block_size
+            block_size *= 2
+        return np.concatenate(matches)[:max_cases]
+
+    def cases_of_reporters(self, reporters: List[str]) -> np.array:
+        """The best-ranked case with each of the given reporters, or -1 for reporters that no case has."""
+        if len(reporters) == 0 or len(self.reporter_keys) == 0:
+            return np.full(len(reporters), -1, dtype="int64")
+        keys = np.array([reporter.encode("utf-8") for reporter in reporters])
+        positions = np.minimum(
+            np.searchsorted(self.reporter_keys, keys), len(self.reporter_keys) - 1
+        )
+        return np.where(
+            self.reporter_keys[positions] == keys, self.reporter_cases[positions], -1
+        )
+
+    def case_fields(self, case: int) -> Dict:
+        court_code = self.courts[case]
+        return {
+            "opinion_id": int(self.opinion_ids[case]),
+            "cluster_id": int(self.cluster_ids[case]),
+            "case_name": self.__text(
+                self.case_name_bytes, self.case_name_offsets, case
+            ),
+            "reporter": self.__text(self.reporter_bytes, self.reporter_offsets, case)
+            or None,
+            "year": int(self.years[case]) or None,
+            "court": COURT_CODES[court_code].value
+            if court_code != UNKNOWN_COURT_CODE
+            else None,
+            "citation_count": int(self.citation_counts[case]),
+        }
+
+    def headline(self, case: int, query: str) -> str:
+        """A case's display name with the words matching the query wrapped in <b></b>, like ts_headline."""
+        fields = self.case_fields(case)
+        display_name = self.display_name(
+            fields["case_name"], fields["reporter"], fields["year"]
+        )
+        terms = tokenize(query)
+        prefix = (
+            terms.pop() if terms and CaseNameIndex.__is_prefix_query(query) else None
+        )
+
+        def highlight(match: re.Match) -> str:
+            token = normalize(match.group())
+            if token in terms or (prefix and token.startswith(prefix)):
+                return f"{HEADLINE_START}{match.group()}{HEADLINE_STOP}"
+            return match.group()
+
+        return TOKEN_PATTERN.sub(highlight, display_name)
+
+    @staticmethod
+    def display_name(case_name: str, reporter: Optional[str], year: Optional[int]):
+        """Plaintiff v. Defendant, Reporter (Year), as in Cluster.case_display_name."""
+        reporter = f", {reporter}" if reporter else ""
+        return f"{case_name}{reporter} ({year or ''})"
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for array_name in CASE_NAME_INDEX_ARRAYS:
+            np.save(
+                os.path.join(tmp_path, f"{array_name}.npy"), getattr(self, array_name)
+            )
+        header = {
+            "format_version": CASE_NAME_INDEX_FORMAT_VERSION,
+            "network_build_id": self.network_build_id,
+            "courts": [court.value for court in COURT_CODES],
+            "created_at": int(time.time()),
+            "num_cases": self.num_cases,
+            "num_tokens": len(self.vocabulary),
+        }
+        with open(os.path.join(tmp_path, CASE_NAME_INDEX_HEADER_FILE), "w") as f:
+            json.dump(header, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(path: str, network_build_id: str = None) -> CaseNameIndex:
+        """
+        Memory-maps an index written by save(). The index is rebuilt along with the network cache, so an index
+        from a different network build is considered stale.
+        """
+        with open(os.path.join(path, CASE_NAME_INDEX_HEADER_FILE)) as f:
+            header = json.load(f)
+        if header.get("format_version") != CASE_NAME_INDEX_FORMAT_VERSION:
+            raise ValueError(
+                f"Case name index format version {header.get('format_version')} does not match "
+                f"expected version {CASE_NAME_INDEX_FORMAT_VERSION}"
+            )
+        if header["courts"] != [court.value for court in COURT_CODES]:
+            raise ValueError(
+                "Case name index court codes do not match the known courts"
+            )
+        if (
+            network_build_id is not None
+            and header["network_build_id"] != network_build_id
+        ):
+            raise ValueError(
+                f"Case name index was built for network build {header['network_build_id']}, not {network_build_id}"
+            )
+        index = CaseNameIndex()
+        index.network_build_id = header["network_build_id"]
+        for array_name in CASE_NAME_INDEX_ARRAYS:
+            setattr(
+                index,
+                array_name,
+                np.load(os.path.join(path, f"{array_name}.npy"), mmap_mode="r"),
+            )
+        return index
+
+    @staticmethod
+    def build(rows: Iterable[CaseNameRow], network_build_id: str) -> CaseNameIndex:
+        rows = sorted(rows, key=lambda row: (-(row[6] or 0), row[0]))
+        Logger.info(f"Indexing the names of {len(rows)} cases...")
+        case_tokens = [
+            sorted(set(tokenize(CaseNameIndex.display_name(name, reporter, year))))
+            for _, _, name, reporter, year, _, _ in rows
+        ]
+        vocabulary = sorted({token for tokens in case_tokens for token in tokens})
+        token_ids = {token: i for i, token in enumerate(vocabulary)}
+
+        index = CaseNameIndex()
+        index.network_build_id = network_build_id
+        index.opinion_ids = np.array([row[0] for row in rows], dtype="int64")
+        index.cluster_ids = np.array([row[1] for row in rows], dtype="int64")
+        index.citation_counts = np.array([row[6] or 0 for row in rows], dtype="int32")
+        index.years = np.array([row[4] or 0 for row in rows], dtype="int16")
+        index.courts = np.array(
+            [COURT_CODE_BY_NAME.get(row[5], UNKNOWN_COURT_CODE) for row in rows],
+            dtype="int8",
+        )
+        index.case_name_offsets, index.case_name_bytes = CaseNameIndex.__pack_texts(
+            row[2] for row in rows
+        )
+        index.reporter_offsets, index.reporter_bytes = CaseNameIndex.__pack_texts(
+            row[3] for row in rows
+        )
+        # Cases are in rank order, so the first case with each reporter is the one it resolves to.
+        reporters = np.array(
+            [(row[3] or "").encode("utf-8") for row in rows], dtype="S"
+        )
+        index.reporter_keys, reporter_cases = np.unique(reporters, return_index=True)
+        has_reporter = index.reporter_keys != b""
+        index.reporter_keys = index.reporter_keys[has_reporter]
+        index.reporter_cases = reporter_cases[has_reporter].astype("int32")
+        index.vocabulary = np.array(
+            vocabulary, dtype=f"S{max(map(len, vocabulary), default=1)}"
+        )
+        index.case_token_offsets = np.zeros(len(rows) + 1, dtype="int64")
+        np.cumsum(
+            [len(tokens) for tokens in case_tokens], out=index.case_token_offsets[1:]
+        )
+        index.case_token_ids = np.array(
+            [token_ids[token] for tokens in case_tokens for token in tokens],
+            dtype="int32",
+        )
+        # A stable sort by word keeps each word's cases in rank order.
+        case_of_token = np.repeat(
+            np.arange(len(rows), dtype="int32"), np.diff(index.case_token_offsets)
+        )
+        index.posting_cases = case_of_token[
+            np.argsort(index.case_token_ids, kind="stable")
+        ]
+        index.vocabulary_offsets = np.zeros(len(vocabulary) + 1, dtype="int64")
+        np.cumsum(
+            np.bincount(index.case_token_ids, minlength=len(vocabulary)),
+            out=index.vocabulary_offsets[1:],
+        )
+        return index
+
+    def __token_ranges(self, query: str) -> List[Tuple[int, int]]:
+        """The range of vocabulary numbers matching each word of a query."""
+        terms = tokenize(query)
+        token_ranges = [
+            (
+                int(np.searchsorted(self.vocabulary, term, side="left")),
+                int(np.searchsorted(self.vocabulary, term, side="right")),
+            )
+            for term in terms
+        ]
+        if token_ranges and CaseNameIndex.__is_prefix_query(query):
+            # No UTF-8 byte is 0xff, so every word starting with the prefix sorts before the prefix + 0xff.
+            token_ranges[-1] = (
+                token_ranges[-1][0],
+                int(np.searchsorted(self.vocabulary, terms[-1] + b"\xff")),
+            )
+        return token_ranges
+
+    def __matches(self, cases: np.array, token_ranges: List[Tuple[int, int]]):
+        """A boolean mask of the given cases that contain a word in every one of the given ranges."""
+        starts = self.case_token_offsets[cases]
+        lengths = self.case_token_offsets[cases + 1] - starts
+        owners = np.repeat(np.arange(len(cases)), lengths)
+        token_ids = self.case_token_ids[
+            np.arange(lengths.sum())
+            + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        ]
+        matches = np.ones(len(cases), dtype="bool")
+        for lo, hi in token_ranges:
+            hits = (token_ids >= lo) & (token_ids < hi)
+            matches &= np.bincount(owners[hits], minlength=len(cases)) > 0
+        return matches
+
+    @staticmethod
+    def __is_prefix_query(query: str) -> bool:
+        return bool(query) and not query[-1].isspace()
+
+    @staticmethod
+    def __text(text_bytes: np.array, offsets: np.array, i: int) -> str:
+        return bytes(text_bytes[offsets[i] : offsets[i + 1]]).decode("utf-8")
+
+    @staticmethod
+    def __pack_texts(texts: Iterable[Optional[str]]) -> Tuple[np.array, np.array]:
+        encoded = [(text or "").encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype="int64")
+        np.cumsum([len(text) for text in encoded], out=offsets[1:])
+        return offsets, np.frombuffer(b"".join(encoded), dtype="uint8")
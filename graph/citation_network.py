@@ -1,25 +1,196 @@
-import pickle
 import os
+from functools import cached_property
+from typing import Optional
 import networkx as nx
+from scipy import sparse
 from gensim.models.keyedvectors import Word2VecKeyedVectors, KeyedVectors
 from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
 
 from db.sqlalchemy import get_session
-from db.sqlalchemy.models import Citation, Court
+from db.sqlalchemy.models import Citation, Cluster, Court, Opinion
+from graph.ann_index import IvfIndex
+from graph.case_name_index import CaseNameIndex
+from graph.minhash_index import (
+    MinHashIndex,
+    DEFAULT_NUM_BANDS,
+    DEFAULT_ROWS_PER_BAND,
+)
 from graph.network_edge_list import NetworkEdgeList
-from utils.io import NETWORK_CACHE_PATH, N2V_MODEL_PATH
+from graph.node_embeddings import NodeEmbeddings
+from graph.walk_vector_store import WalkVectorStore
+from utils.io import (
+    NETWORK_CACHE_PATH,
+    N2V_MODEL_PATH,
+    N2V_ANN_INDEX_PATH,
+    N2V_EMBEDDINGS_PATH,
+    MINHASH_INDEX_PATH,
+    CASE_NAME_INDEX_PATH,
+    WALK_VECTORS_PATH,
+)
 from utils.logger import Logger
 
 
 class CitationNetwork:
     network: nx.Graph
     network_edge_list: NetworkEdgeList
-    n2v_model: Word2VecKeyedVectors
 
-    def __init__(self, directed=False, scotus_only=False):
+    def __init__(self, directed=False, scotus_only=False, network_edge_list=None):
         # self.network = self.construct_network(directed, scotus_only)
-        self.network_edge_list = NetworkEdgeList(scotus_only)
-        self.n2v_model = self.get_n2v_model()
+        self.network_edge_list = network_edge_list or NetworkEdgeList(scotus_only)
+
+    @cached_property
+    def adjacency_matrix(self) -> sparse.csr_matrix:
+        return self.network_edge_list.adjacency_matrix()
+
+    @cached_property
+    def minhash_index(self) -> Optional[MinHashIndex]:
+        """The LSH index over neighbor sets used by CaseSimilarity, if one was built for this network."""
+        if not os.path.exists(MINHASH_INDEX_PATH):
+            return None
+        try:
+            return MinHashIndex.load(
+                MINHASH_INDEX_PATH, network_build_id=self.network_edge_list.build_id
+            )
+        except (OSError, ValueError, KeyError) as err:
+            Logger.info(f"Not using MinHash index: {err}")
+            return None
+
+    def build_minhash_index(
+        self,
+        num_bands=DEFAULT_NUM_BANDS,
+        rows_per_band=DEFAULT_ROWS_PER_BAND,
+        seed=0,
+    ) -> MinHashIndex:
+        index = MinHashIndex.build(
+            self.adjacency_matrix,
+            network_build_id=self.network_edge_list.build_id,
+            num_bands=num_bands,
+            rows_per_band=rows_per_band,
+            seed=seed,
+        )
+        Logger.info(f"Writing MinHash index to {MINHASH_INDEX_PATH}...")
+        index.save(MINHASH_INDEX_PATH)
+        self.__dict__["minhash_index"] = index
+        return index
+
+    @cached_property
+    def n2v_model(self) -> Word2VecKeyedVectors:
+        return self.get_n2v_model()
+
+    @cached_property
+    def node_embeddings(self) -> Optional[NodeEmbeddings]:
+        """
+        The n2v model's vectors as a normalized matrix aligned to network node indices. Memory-mapped from the
+        embedding store if one was written for this network and model, otherwise parsed from the model file.
+        """
+        if not os.path.exists(N2V_MODEL_PATH):
+            Logger.warn("N2V model not found, n2v recommendations will error...")
+            return None
+        if os.path.exists(N2V_EMBEDDINGS_PATH):
+            try:
+                return NodeEmbeddings.load(
+                    N2V_EMBEDDINGS_PATH,
+                    network_build_id=self.network_edge_list.build_id,
+                    model_mtime=os.path.getmtime(N2V_MODEL_PATH),
+                )
+            except (OSError, ValueError, KeyError) as err:
+                Logger.info(f"Not using n2v embedding store: {err}")
+        return NodeEmbeddings.from_keyed_vectors(self.n2v_model, self.network_edge_list)
+
+    def build_embedding_store(self, quantization="float32") -> NodeEmbeddings:
+        if not os.path.exists(N2V_MODEL_PATH):
+            raise ValueError("N2V model not found, cannot build an embedding store.")
+        embeddings = NodeEmbeddings.from_keyed_vectors(
+            self.n2v_model, self.network_edge_list
+        ).quantized(quantization)
+        Logger.info(
+            f"Writing {quantization} n2v embeddings to {N2V_EMBEDDINGS_PATH}..."
+        )
+        embeddings.save(
+            N2V_EMBEDDINGS_PATH,
+            network_build_id=self.network_edge_list.build_id,
+            model_mtime=os.path.getmtime(N2V_MODEL_PATH),
+        )
+        self.__dict__["node_embeddings"] = embeddings
+        return embeddings
+
+    @cached_property
+    def ann_index(self) -> Optional[IvfIndex]:
+        """The approximate nearest-neighbor index over node_embeddings, if one was built for this network and model."""
+        if not os.path.exists(N2V_ANN_INDEX_PATH) or not os.path.exists(N2V_MODEL_PATH):
+            return None
+        try:
+            return IvfIndex.load(
+                N2V_ANN_INDEX_PATH,
+                network_build_id=self.network_edge_list.build_id,
+                model_mtime=os.path.getmtime(N2V_MODEL_PATH),
+            )
+        except (OSError, ValueError, KeyError) as err:
+            Logger.info(f"Not using n2v ANN index: {err}")
+            return None
+
+    def build_ann_index(self, num_lists=None, seed=0) -> IvfIndex:
+        if self.node_embeddings is None:
+            raise ValueError("N2V model not found, cannot build an ANN index.")
+        index = IvfIndex.build(
+            self.node_embeddings,
+            self.network_edge_list.court,
+            network_build_id=self.network_edge_list.build_id,
+            model_mtime=os.path.getmtime(N2V_MODEL_PATH),
+            num_lists=num_lists,
+            seed=seed,
+        )
+        Logger.info(f"Writing n2v ANN index to {N2V_ANN_INDEX_PATH}...")
+        index.save(N2V_ANN_INDEX_PATH)
+        self.__dict__["ann_index"] = index
+        return index
+
+    @cached_property
+    def walk_vector_store(self) -> Optional[WalkVectorStore]:
+        """Precomputed random-walk visit vectors for this network, if they have been computed for this build."""
+        if not os.path.exists(WALK_VECTORS_PATH):
+            return None
+        try:
+            return WalkVectorStore.load(
+                WALK_VECTORS_PATH, network_build_id=self.network_edge_list.build_id
+            )
+        except (OSError, ValueError, KeyError) as err:
+            Logger.info(f"Not using precomputed walk vectors: {err}")
+            return None
+
+    @cached_property
+    def case_name_index(self) -> Optional[CaseNameIndex]:
+        """The in-process case name search index, if one was built along with this network."""
+        if not os.path.exists(CASE_NAME_INDEX_PATH):
+            return None
+        try:
+            return CaseNameIndex.load(
+                CASE_NAME_INDEX_PATH, network_build_id=self.network_edge_list.build_id
+            )
+        except (OSError, ValueError, KeyError) as err:
+            Logger.info(f"Not using case name index: {err}")
+            return None
+
+    def build_case_name_index(self) -> CaseNameIndex:
+        case_query = select(
+            Opinion.resource_id,
+            Cluster.resource_id,
+            Cluster.case_name,
+            Cluster.reporter,
+            Cluster.year,
+            Cluster.court,
+            Cluster.citation_count,
+        ).join(Opinion.cluster)
+        with get_session() as s:
+            rows = s.execute(case_query).all()
+        index = CaseNameIndex.build(
+            rows, network_build_id=self.network_edge_list.build_id
+        )
+        Logger.info(f"Writing case name index to {CASE_NAME_INDEX_PATH}...")
+        index.save(CASE_NAME_INDEX_PATH)
+        self.__dict__["case_name_index"] = index
+        return index
 
     @staticmethod
     def get_citation_network(enable_caching=True, scotus_only=False):
@@ -29,28 +200,37 @@ class CitationNetwork:
         if os.path.exists(NETWORK_CACHE_PATH):
             Logger.info("Loading citation network from disk cache...")
             try:
-                with open(NETWORK_CACHE_PATH, "rb") as cache_file:
-                    return pickle.load(cache_file)
-            except BaseException as err:
+                network_edge_list = NetworkEdgeList.load(NETWORK_CACHE_PATH)
+                if network_edge_list.scotus_only != scotus_only:
+                    raise ValueError(
+                        f"Cached network has scotus_only={network_edge_list.scotus_only}"
+                    )
+                return CitationNetwork(network_edge_list=network_edge_list)
+            except (OSError, ValueError, KeyError) as err:
                 Logger.error(
-                    "Loading citation network from cache file failed with error:", err
-                )
-                Logger.info("Creating citation network from database...")
-                return CitationNetwork(
-                    scotus_only=scotus_only
-                )  # Create a new network if fetching from cache fails
-        else:  # Otherwise, construct a new network and cache it.
-            Logger.info("Creating citation network from database...")
-            new_network = CitationNetwork(scotus_only=scotus_only)
-            try:
-                Logger.info("Writing network cache to disk...")
-                with open(NETWORK_CACHE_PATH, "wb") as cache_file:
-                    pickle.dump(new_network, cache_file)
-            except BaseException as err:
-                Logger.info(
-                    "Saving citation network to cache file failed with error:", err
+                    f"Loading citation network from cache file failed with error: {err}"
                 )
+        # Otherwise, construct a new network and cache it.
+        return CitationNetwork.build_citation_network_cache(scotus_only=scotus_only)
+
+    @staticmethod
+    def build_citation_network_cache(scotus_only=False):
+        Logger.info("Creating citation network from database...")
+        new_network = CitationNetwork(scotus_only=scotus_only)
+        try:
+            Logger.info("Writing network cache to disk...")
+            new_network.network_edge_list.save(NETWORK_CACHE_PATH)
+        except (OSError, ValueError, KeyError) as err:
+            Logger.info(
+                f"Saving citation network to cache file failed with error: {err}"
+            )
             return new_network
+        try:
+            # The search index is tied to the network build, so it is rebuilt with every new cache.
+            new_network.build_case_name_index()
+        except (OSError, ValueError, KeyError, SQLAlchemyError) as err:
+            Logger.info(f"Building case name index failed with error: {err}")
+        return new_network
 
     @staticmethod
     def construct_network(directed, scotus_only):
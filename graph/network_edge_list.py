@@ -1,8 +1,13 @@
 from __future__ import annotations
 
-from collections import defaultdict
-from typing import NamedTuple, Dict, List
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Dict, Iterable, Optional
 import numpy as np
+from scipy import sparse
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
@@ -10,24 +15,45 @@ from db.sqlalchemy import get_session
 from db.sqlalchemy.models import *
 from utils.logger import Logger
 
+# Bump this whenever the set of arrays or their meaning changes so that stale caches get rebuilt.
+NETWORK_CACHE_FORMAT_VERSION = 2
+NETWORK_CACHE_HEADER_FILE = "header.json"
+NETWORK_CACHE_ARRAYS = (
+    "node_ids",
+    "offsets",
+    "in_offsets",
+    "edge_list",
+    "year",
+    "court",
+)
 
-class NodeMetadata(NamedTuple):
-    start: int
-    end_in_neighbors: int
-    end: int
-    length: int
-    year: int
-    court: str
+COURT_CODES = list(Court)  # The on-disk court code of a node is its index in this list
+COURT_CODE_BY_NAME: Dict[str, int] = {
+    court.value: code for code, court in enumerate(COURT_CODES)
+}
+UNKNOWN_COURT_CODE = -1
+UNKNOWN_YEAR = 0
 
 
 class NetworkEdgeList:
     """
-    An alternative representation of a network that is optimized for random sampling of neighbors
+    An alternative representation of a network that is optimized for random sampling of neighbors.
+
+    Opinions are identified by a compact node index: the position of their resource_id in the sorted node_ids
+    array. The network is stored in CSR form over these indices: the neighbors of node i are
+    edge_list[offsets[i]:offsets[i + 1]], with in-neighbors (citing opinions) before in_offsets[i] and
+    out-neighbors (cited opinions) after it. Year and court code are stored as parallel columns. All of these
+    are plain NumPy arrays, so they can be written to disk with save() and memory-mapped back with load().
     """
 
     scotus_only: bool
+    node_ids: np.array
+    offsets: np.array
+    in_offsets: np.array
     edge_list: np.array
-    node_metadata: Dict[int, NodeMetadata]
+    year: np.array
+    court: np.array
+    build_id: str
     session: Session | None
 
     def __init__(self, scotus_only):
@@ -36,70 +62,194 @@ class NetworkEdgeList:
         self.session = (
             get_session()
         )  # At some point we will get better session management, pinky promise.
-        in_neighbor_dict, out_neighbor_dict = self.__get_neighbor_dicts()
-        self.__populate_edge_list_and_metadata(in_neighbor_dict, out_neighbor_dict)
+        self.__populate_edge_list(self.__get_edges())
+        self.__populate_node_columns()
         self.session.close()
         self.session = None
+        self.build_id = uuid.uuid4().hex
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.node_ids)
+
+    def index_of(self, opinion_id) -> Optional[int]:
+        idx = int(np.searchsorted(self.node_ids, opinion_id))
+        if idx < len(self.node_ids) and self.node_ids[idx] == opinion_id:
+            return idx
+        return None
+
+    def indices_of(self, opinion_ids: Iterable[int]) -> np.array:
+        """Vectorized index_of, with -1 for opinions that aren't in the network."""
+        opinion_ids = np.fromiter(opinion_ids, dtype="int64")
+        if len(self.node_ids) == 0:
+            return np.full(len(opinion_ids), -1, dtype="int32")
+        indices = np.minimum(
+            np.searchsorted(self.node_ids, opinion_ids), len(self.node_ids) - 1
+        ).astype("int32")
+        indices[self.node_ids[indices] != opinion_ids] = -1
+        return indices
+
+    def opinion_id_of(self, idx: int) -> int:
+        return int(self.node_ids[idx])
+
+    def opinion_ids_of(self, indices: np.array) -> np.array:
+        return self.node_ids[indices]
+
+    def degree(self, idx: int) -> int:
+        return int(self.offsets[idx + 1] - self.offsets[idx])
+
+    def neighbors(self, idx: int) -> np.array:
+        return self.edge_list[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def out_neighbors(self, idx: int) -> np.array:
+        return self.edge_list[self.in_offsets[idx] : self.offsets[idx + 1]]
 
-    def __get_neighbor_dicts(self) -> Tuple[Dict[int, List[int]], Dict[int, List[int]]]:
+    def year_of(self, idx: int) -> Optional[int]:
+        year = int(self.year[idx])
+        return year if year != UNKNOWN_YEAR else None
+
+    def court_of(self, idx: int) -> Optional[str]:
+        court_code = int(self.court[idx])
+        return (
+            COURT_CODES[court_code].value if court_code != UNKNOWN_COURT_CODE else None
+        )
+
+    def adjacency_matrix(self) -> sparse.csr_matrix:
+        """
+        The network as a binary, symmetric SciPy CSR matrix over node indices, i.e. row i marks the neighbors of
+        node i. Built directly from the CSR arrays, with each pair of mutual citations merged into one entry.
+        """
+        # Copies, since sum_duplicates() sorts the indices in place and the cached arrays are read-only mappings.
+        matrix = sparse.csr_matrix(
+            (
+                np.ones(len(self.edge_list), dtype="float32"),
+                np.array(self.edge_list),
+                np.array(self.offsets),
+            ),
+            shape=(self.num_nodes, self.num_nodes),
+        )
+        matrix.sum_duplicates()
+        matrix.data[:] = 1
+        return matrix
+
+    @staticmethod
+    def court_codes_of(courts: Iterable[str]) -> np.array:
+        return np.array(
+            [COURT_CODE_BY_NAME[c] for c in courts if c in COURT_CODE_BY_NAME],
+            dtype="int8",
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Writes the edge list to the given directory, replacing any existing cache there. The new cache is written
+        to a temporary directory first so that processes reading the old one never see a half-written network.
+        """
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for array_name in NETWORK_CACHE_ARRAYS:
+            np.save(
+                os.path.join(tmp_path, f"{array_name}.npy"), getattr(self, array_name)
+            )
+        header = {
+            "format_version": NETWORK_CACHE_FORMAT_VERSION,
+            "build_id": self.build_id,
+            "created_at": int(time.time()),
+            "scotus_only": self.scotus_only,
+            "courts": [court.value for court in COURT_CODES],
+            "num_nodes": len(self.node_ids),
+            "num_edges": len(self.edge_list),
+        }
+        with open(os.path.join(tmp_path, NETWORK_CACHE_HEADER_FILE), "w") as f:
+            json.dump(header, f)
+        old_path = f"{path}.old-{os.getpid()}"
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        # Processes that already mapped the old arrays keep working, since the unlinked files stay alive until unmapped.
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @staticmethod
+    def cached_build_id(path: str) -> Optional[str]:
+        """The build ID of the edge list cached at path, read from its header alone, or None if there is none."""
+        try:
+            with open(os.path.join(path, NETWORK_CACHE_HEADER_FILE)) as f:
+                return json.load(f).get("build_id")
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def load(path: str) -> NetworkEdgeList:
+        """
+        Memory-maps a cached edge list written by save(). Pages are shared between every process that maps the
+        same cache, so loading is nearly instant and costs no private memory.
+        """
+        with open(os.path.join(path, NETWORK_CACHE_HEADER_FILE)) as f:
+            header = json.load(f)
+        if header.get("format_version") != NETWORK_CACHE_FORMAT_VERSION:
+            raise ValueError(
+                f"Network cache format version {header.get('format_version')} does not match "
+                f"expected version {NETWORK_CACHE_FORMAT_VERSION}"
+            )
+        if header["courts"] != [court.value for court in COURT_CODES]:
+            raise ValueError("Network cache court codes do not match the known courts")
+        edge_list = NetworkEdgeList.__new__(NetworkEdgeList)
+        edge_list.scotus_only = header["scotus_only"]
+        edge_list.build_id = header["build_id"]
+        edge_list.session = None
+        for array_name in NETWORK_CACHE_ARRAYS:
+            setattr(
+                edge_list,
+                array_name,
+                np.load(os.path.join(path, f"{array_name}.npy"), mmap_mode="r"),
+            )
+        return edge_list
+
+    def __get_edges(self) -> np.array:
         edge_query = select(Citation.citing_opinion_id, Citation.cited_opinion_id)
         if self.scotus_only:
             edge_query = Citation.where_court(
                 edge_query, citing_court=Court.SCOTUS, cited_court=Court.SCOTUS
             )
-        edges: List[Tuple[int, int]] = self.session.execute(edge_query).all()
-        opinion_in_neighbor_dict: Dict[int, List[int]] = defaultdict(list)
-        opinion_out_neighbor_dict: Dict[int, List[int]] = defaultdict(list)
-        for (citing, cited) in edges:
-            opinion_out_neighbor_dict[citing].append(cited)
-            opinion_in_neighbor_dict[cited].append(citing)
-        # Kind of a dumb place to initialize this but we have the number of edges here so may as well.
-        self.edge_list = np.empty(len(edges) * 2, dtype="int32")
-        return opinion_in_neighbor_dict, opinion_out_neighbor_dict
-
-    def __populate_edge_list_and_metadata(
-        self,
-        in_neighbor_dict: Dict[int, List[int]],
-        out_neighbor_dict: Dict[int, List[int]],
-    ):
-        self.node_metadata = {}
-        opinion_year_query = select(Opinion.resource_id, Cluster.year).join(
-            Opinion.cluster
+        edges = self.session.execute(edge_query).all()
+        return np.array(edges, dtype="int32").reshape(-1, 2)
+
+    def __populate_edge_list(self, edges: np.array) -> None:
+        self.node_ids = np.unique(edges)
+        citing, cited = (
+            np.searchsorted(self.node_ids, edges[:, 0]).astype("int32"),
+            np.searchsorted(self.node_ids, edges[:, 1]).astype("int32"),
         )
-        opinion_court_query = select(Opinion.resource_id, Cluster.court).join(
+        # Each citation contributes an in-neighbor entry to the cited node and an out-neighbor entry to the citing node.
+        owner = np.concatenate((cited, citing))
+        neighbor = np.concatenate((citing, cited))
+        is_out_neighbor = np.repeat(np.array([0, 1], dtype="int8"), len(edges))
+        order = np.lexsort((is_out_neighbor, owner))
+        self.edge_list = neighbor[order]
+        degrees = np.bincount(owner, minlength=len(self.node_ids))
+        in_degrees = np.bincount(cited, minlength=len(self.node_ids))
+        self.offsets = np.zeros(len(self.node_ids) + 1, dtype="int64")
+        np.cumsum(degrees, out=self.offsets[1:])
+        self.in_offsets = self.offsets[:-1] + in_degrees
+
+    def __populate_node_columns(self) -> None:
+        opinion_query = select(Opinion.resource_id, Cluster.year, Cluster.court).join(
             Opinion.cluster
         )
         if self.scotus_only:
-            opinion_year_query = opinion_year_query.filter(
-                Cluster.court == Court.SCOTUS
-            )
-        opinion_year_dict = {
-            op_id: year
-            for op_id, year in self.session.execute(opinion_year_query).all()
-        }
-        opinion_court_dict = {
-            op_id: court
-            for op_id, court in self.session.execute(opinion_court_query).all()
-        }
-        prev_index = 0
-        ids = set(in_neighbor_dict.keys())
-        ids.update(out_neighbor_dict.keys())
-        for opinion_id in ids:
-            start_idx = prev_index
-            in_neighbors, out_neighbors = (
-                in_neighbor_dict[opinion_id],
-                out_neighbor_dict[opinion_id],
-            )
-            end_in_neighbor_idx = start_idx + len(in_neighbors)
-            end_idx = start_idx + len(in_neighbors) + len(out_neighbors)
-            self.node_metadata[opinion_id] = NodeMetadata(
-                start=start_idx,
-                end_in_neighbors=end_in_neighbor_idx,
-                end=end_idx,
-                length=len(in_neighbors) + len(out_neighbors),
-                court=opinion_court_dict.get(opinion_id),
-                year=opinion_year_dict.get(opinion_id),
-            )
-            self.edge_list[start_idx:end_in_neighbor_idx] = in_neighbors
-            self.edge_list[end_in_neighbor_idx:end_idx] = out_neighbors
-            prev_index = end_idx
+            opinion_query = opinion_query.filter(Cluster.court == Court.SCOTUS)
+        self.year = np.full(len(self.node_ids), UNKNOWN_YEAR, dtype="int16")
+        self.court = np.full(len(self.node_ids), UNKNOWN_COURT_CODE, dtype="int8")
+        rows = self.session.execute(opinion_query).all()
+        indices = self.indices_of(op_id for op_id, _, _ in rows)
+        years = np.array(
+            [year if year is not None else UNKNOWN_YEAR for _, year, _ in rows],
+            dtype="int16",
+        )
+        courts = np.array(
+            [COURT_CODE_BY_NAME.get(court, UNKNOWN_COURT_CODE) for _, _, court in rows],
+            dtype="int8",
+        )
+        in_network = indices != -1
+        self.year[indices[in_network]] = years[in_network]
+        self.court[indices[in_network]] = courts[in_network]
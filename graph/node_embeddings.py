@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import time
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+from gensim.models.keyedvectors import Word2VecKeyedVectors
+
+from graph.network_edge_list import NetworkEdgeList
+
+EMBEDDING_STORE_FORMAT_VERSION = 1
+EMBEDDING_STORE_HEADER_FILE = "header.json"
+QUANTIZATIONS = ("float32", "float16", "int8")
+INT8_MAX = 127
+# Quantized scores pick this many times the requested number of nodes, which are then rescored at full precision
+DEFAULT_RESCORE_FACTOR = 4
+SCORING_CHUNK_SIZE = 65_536
+
+
+class NodeEmbeddings:
+    """
+    Node2Vec embeddings aligned to the node indices of a network: vectors[i] is the unit-normalized embedding of
+    node i, or all zeros if the model has no vector for it (in which case has_vector[i] is False). Since the rows
+    are normalized, cosine similarity to a unit query vector is a single matrix-vector product.
+
+    The vectors may be scalar-quantized to float16 or int8 (with a per-row scale, so that vectors[i] * scales[i]
+    approximates the embedding). Quantized embeddings keep the float32 vectors in full_vectors to rescore the best
+    quantized matches with. Saved stores are memory-mapped by load(), so only the rows that a query touches are
+    read from disk and the pages are shared between processes.
+    """
+
+    quantization: str
+    vectors: np.array
+    scales: Optional[np.array]
+    full_vectors: Optional[np.array]
+    has_vector: np.array
+
+    def __init__(
+        self,
+        vectors: np.array,
+        has_vector: np.array,
+        quantization="float32",
+        scales: np.array = None,
+        full_vectors: np.array = None,
+    ):
+        self.quantization = quantization
+        self.vectors = vectors
+        self.has_vector = has_vector
+        self.scales = scales
+        self.full_vectors = full_vectors
+
+    @property
+    def dimensions(self) -> int:
+        return self.vectors.shape[1]
+
+    def float_vectors(self, node_indices: np.array) -> np.array:
+        """The float32 vectors of the given nodes, dequantized if no full-precision copy is stored."""
+        if self.full_vectors is not None:
+            return np.asarray(self.full_vectors[node_indices])
+        vectors = np.asarray(self.vectors[node_indices], dtype="float32")
+        if self.scales is not None:
+            vectors *= self.scales[node_indices, np.newaxis]
+        return vectors
+
+    def query_vector(self, node_indices: Iterable[int]) -> np.array:
+        """
+        The normalized mean of the given nodes' vectors, like gensim's most_similar(positive=...) query. Nodes
+        without a vector are skipped; returns None if none of them has one.
+        """
+        node_indices = np.fromiter(node_indices, dtype="int64")
+        node_indices = node_indices[self.has_vector[node_indices]]
+        if len(node_indices) == 0:
+            return None
+        query = self.float_vectors(node_indices).mean(axis=0)
+        return query / np.linalg.norm(query)
+
+    def similarities(self, query: np.array, node_indices: np.array = None) -> np.array:
+        """
+        Cosine similarities of a unit query vector to the given nodes, or to every node if none are given, computed
+        from the (possibly quantized) vectors a chunk at a time.
+        """
+        num_nodes = len(self.vectors) if node_indices is None else len(node_indices)
+        similarities = np.empty(num_nodes, dtype="float32")
+        for start in range(0, num_nodes, SCORING_CHUNK_SIZE):
+            rows = (
+                slice(start, start + SCORING_CHUNK_SIZE)
+                if node_indices is None
+                else node_indices[start : start + SCORING_CHUNK_SIZE]
+            )
+            chunk = np.asarray(self.vectors[rows], dtype="float32") @ query
+            if self.scales is not None:
+                chunk *= self.scales[rows]
+            similarities[start : start + len(chunk)] = chunk
+        return similarities
+
+    def nearest(
+        self,
+        query: np.array,
+        node_indices: np.array,
+        num_nearest: int,
+        rescore_factor=DEFAULT_RESCORE_FACTOR,
+    ) -> Tuple[np.array, np.array]:
+        """
+        Scores the given nodes against a unit query vector. With quantized vectors, only the
+        rescore_factor * num_nearest best quantized matches are returned, with their full-precision similarities.
+
+        :return: The (possibly shortlisted) node indices and their similarities, in no particular order
+        """
+        if self.full_vectors is None:
+            return node_indices, self.similarities(query, node_indices)
+        num_rescored = num_nearest * rescore_factor
+        if len(node_indices) <= num_rescored:
+            return node_indices, self.float_vectors(node_indices) @ query
+        similarities = self.similarities(query, node_indices)
+        shortlist = np.sort(
+            node_indices[np.argpartition(-similarities, num_rescored)[:num_rescored]]
+        )
+        return shortlist, self.float_vectors(shortlist) @ query
+
+    def quantized(self, quantization: str) -> NodeEmbeddings:
+        """Quantizes float32 embeddings, keeping the float32 vectors for rescoring."""
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}")
+        full_vectors = self.float_vectors(np.arange(len(self.vectors)))
+        if quantization == "float32":
+            return NodeEmbeddings(full_vectors, self.has_vector)
+        if quantization == "float16":
+            return NodeEmbeddings(
+                full_vectors.astype("float16"),
+                self.has_vector,
+                quantization,
+                full_vectors=full_vectors,
+            )
+        scales = np.abs(full_vectors).max(axis=1) / INT8_MAX
+        safe_scales = np.where(scales > 0, scales, 1)
+        codes = np.rint(full_vectors / safe_scales[:, np.newaxis]).astype("int8")
+        return NodeEmbeddings(
+            codes,
+            self.has_vector,
+            quantization,
+            scales=scales.astype("float32"),
+            full_vectors=full_vectors,
+        )
+
+    def save(self, path: str, network_build_id: str, model_mtime: float) -> None:
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        arrays = {
+            "vectors": self.vectors,
+            "has_vector": self.has_vector,
+            "scales": self.scales,
+            "full_vectors": self.full_vectors,
+        }
+        for array_name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(tmp_path, f"{array_name}.npy"), array)
+        header = {
+            "format_version": EMBEDDING_STORE_FORMAT_VERSION,
+            "network_build_id": network_build_id,
+            "model_mtime": model_mtime,
+            "quantization": self.quantization,
+            "created_at": int(time.time()),
+            "num_nodes": len(self.vectors),
+            "dimensions": self.dimensions,
+        }
+        with open(os.path.join(tmp_path, EMBEDDING_STORE_HEADER_FILE), "w") as f:
+            json.dump(header, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def load(
+        path: str, network_build_id: str = None, model_mtime: float = None
+    ) -> NodeEmbeddings:
+        """
+        Memory-maps an embedding store written by save(). Rows are only meaningful for the network build the store
+        was written for, and the vectors only for the model they came from, so both are checked if given.
+        """
+        with open(os.path.join(path, EMBEDDING_STORE_HEADER_FILE)) as f:
+            header = json.load(f)
+        if header.get("format_version") != EMBEDDING_STORE_FORMAT_VERSION:
+            raise ValueError(
+                f"Embedding store format version {header.get('format_version')} does not match "
+                f"expected version {EMBEDDING_STORE_FORMAT_VERSION}"
+            )
+        if (
+            network_build_id is not None
+            and header["network_build_id"] != network_build_id
+        ):
+            raise ValueError(
+                f"Embeddings were stored for network build {header['network_build_id']}, not {network_build_id}"
+            )
+        if model_mtime is not None and header["model_mtime"] != model_mtime:
+            raise ValueError("Embeddings were stored from a different n2v model")
+
+        def load_array(array_name: str) -> Optional[np.array]:
+            array_path = os.path.join(path, f"{array_name}.npy")
+            if not os.path.exists(array_path):
+                return None
+            return np.load(array_path, mmap_mode="r")
+
+        return NodeEmbeddings(
+            load_array("vectors"),
+            load_array("has_vector"),
+            header["quantization"],
+            scales=load_array("scales"),
+            full_vectors=load_array("full_vectors"),
+        )
+
+    @staticmethod
+    def from_keyed_vectors(
+        keyed_vectors: Word2VecKeyedVectors, network_edge_list: NetworkEdgeList
+    ) -> NodeEmbeddings:
+        # gensim 4 renamed index2word to index_to_key
+        keys = getattr(keyed_vectors, "index_to_key", None)
+        if keys is None:
+            keys = keyed_vectors.index2word
+        model_vectors = np.asarray(keyed_vectors.vectors, dtype="float32")
+        node_indices = network_edge_list.indices_of(int(key) for key in keys)
+        in_network = node_indices != -1
+        vectors = np.zeros(
+            (network_edge_list.num_nodes, model_vectors.shape[1]), dtype="float32"
+        )
+        vectors[node_indices[in_network]] = model_vectors[in_network]
+        norms = np.linalg.norm(vectors, axis=1)
+        has_vector = norms > 0
+        vectors[has_vector] /= norms[has_vector, np.newaxis]
+        return NodeEmbeddings(vectors, has_vector)
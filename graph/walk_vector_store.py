@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from typing import Tuple
+
+import numpy as np
+
+WALK_VECTOR_FORMAT_VERSION = 2
+WALK_VECTOR_HEADER_FILE = "header.json"
+WALK_VECTOR_ARRAYS = {
+    "offsets": "int64",
+    "nodes": "int32",
+    "visit_counts": "float32",
+    "num_steps": "int64",
+}
+
+
+class WalkVectorStore:
+    """
+    Truncated random-walk visit vectors for every node of a network, in CSR form: the top_k most visited nodes of
+    the walks from node i are nodes[offsets[i]:offsets[i + 1]], with how often each of them was visited in
+    visit_counts, and the number of steps those walks took in num_steps[i].
+
+    The arrays are raw binary files (their length isn't known until the offline job finishes) that load() maps
+    with np.memmap. A store is only valid for the network build it was computed from.
+    """
+
+    network_build_id: str
+    top_k: int
+    max_walk_length: int
+    early_stopping: bool
+    offsets: np.array
+    nodes: np.array
+    visit_counts: np.array
+    num_steps: np.array
+
+    def has_vector(self, node_idx: int) -> bool:
+        return node_idx < len(self.num_steps) and self.num_steps[node_idx] > 0
+
+    def vector(self, node_idx: int) -> Tuple[np.array, np.array, int]:
+        start, end = self.offsets[node_idx], self.offsets[node_idx + 1]
+        return (
+            self.nodes[start:end],
+            self.visit_counts[start:end],
+            int(self.num_steps[node_idx]),
+        )
+
+    @staticmethod
+    def load(path: str, network_build_id: str = None) -> WalkVectorStore:
+        with open(os.path.join(path, WALK_VECTOR_HEADER_FILE)) as f:
+            header = json.load(f)
+        if header.get("format_version") != WALK_VECTOR_FORMAT_VERSION:
+            raise ValueError(
+                f"Walk vector format version {header.get('format_version')} does not match "
+                f"expected version {WALK_VECTOR_FORMAT_VERSION}"
+            )
+        if (
+            network_build_id is not None
+            and header["network_build_id"] != network_build_id
+        ):
+            raise ValueError(
+                f"Walk vectors were computed for network build {header['network_build_id']}, "
+                f"not {network_build_id}"
+            )
+        store = WalkVectorStore()
+        store.network_build_id = header["network_build_id"]
+        store.top_k = header["top_k"]
+        store.max_walk_length = header["max_walk_length"]
+        store.early_stopping = header["early_stopping"]
+        for array_name, dtype in WALK_VECTOR_ARRAYS.items():
+            file_path = os.path.join(path, f"{array_name}.bin")
+            setattr(
+                store,
+                array_name,
+                np.memmap(file_path, dtype=dtype, mode="r")
+                if os.path.getsize(file_path) > 0
+                else np.empty(0, dtype=dtype),
+            )
+        return store
+
+
+class WalkVectorStoreWriter:
+    """
+    Streams walk vectors to disk in node order, so the offline job never has to hold all of them in memory.
+    """
+
+    path: str
+    tmp_path: str
+    header: dict
+
+    def __init__(
+        self,
+        path: str,
+        network_build_id: str,
+        top_k: int,
+        max_walk_length: int,
+        early_stopping: bool,
+    ):
+        self.path = path
+        self.tmp_path = f"{path}.tmp-{os.getpid()}"
+        self.header = {
+            "format_version": WALK_VECTOR_FORMAT_VERSION,
+            "network_build_id": network_build_id,
+            "top_k": top_k,
+            "max_walk_length": max_walk_length,
+            "early_stopping": early_stopping,
+        }
+        self.__num_entries = 0
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.__files = {
+            array_name: open(os.path.join(self.tmp_path, f"{array_name}.bin"), "wb")
+            for array_name in WALK_VECTOR_ARRAYS
+        }
+        self.__write("offsets", np.zeros(1))
+
+    def append(self, nodes: np.array, visit_counts: np.array, num_steps: int) -> None:
+        self.__num_entries += len(nodes)
+        self.__write("nodes", nodes)
+        self.__write("visit_counts", visit_counts)
+        self.__write("num_steps", np.array([num_steps]))
+        self.__write("offsets", np.array([self.__num_entries]))
+
+    def close(self) -> None:
+        for file in self.__files.values():
+            file.close()
+        with open(os.path.join(self.tmp_path, WALK_VECTOR_HEADER_FILE), "w") as f:
+            json.dump(self.header, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(self.tmp_path, self.path)
+
+    def __write(self, array_name: str, values: np.array) -> None:
+        self.__files[array_name].write(
+            np.ascontiguousarray(values, dtype=WALK_VECTOR_ARRAYS[array_name]).tobytes()
+        )
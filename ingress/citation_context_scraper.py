@@ -1,6 +1,7 @@
 import re
-from collections import defaultdict
+import time
 from multiprocessing import Pool
+from typing import List, Optional, Tuple
 
 from sqlalchemy.orm import Session
 
@@ -9,20 +10,21 @@ from db.sqlalchemy.models import (
     Cluster,
     OpinionParenthetical,
     CitationContext,
-    Court,
 )
-from db.sqlalchemy.helpers import get_session, ENGINE, get_db_url
+from db.sqlalchemy.helpers import ENGINE, get_db_url, keyset_iterator
 from extraction.parenthetical_processor import ParentheticalProcessor
+from extraction.tokenizers import OneTimeTokenizer, get_tokenizer
+from graph import CitationNetwork
+from graph.case_name_index import CaseNameIndex
 from ingress.helpers import JURISDICTIONS
 from bs4 import BeautifulSoup
 from sqlalchemy import select, create_engine
 from utils.format import format_reporter
 import eyecite
 from eyecite.models import CaseCitation
-from eyecite.tokenizers import Tokenizer, AhocorasickTokenizer, HyperscanTokenizer
 from string import ascii_lowercase
 
-from utils.io import get_full_path, HYPERSCAN_TMP_PATH
+from utils.io import get_full_path, CASE_NAME_INDEX_PATH
 from utils.logger import Logger
 
 STOP_WORDS = {
@@ -205,159 +207,219 @@ STOP_WORDS = {
     "court's",
 }
 LETTERS = set(ascii_lowercase)
+OPINIONS_PER_CHUNK = 1_000
+OPINION_TEXT_BATCH_SIZE = 100
 
+# Per-process database engine and case name index, set up once by _init_worker since connections can't be shared
+# with the parent process and the index is memory-mapped rather than pickled. The tokenizer is compiled before the
+# pool forks, so workers inherit it.
+_worker_engine = None
+_worker_case_name_index: Optional[CaseNameIndex] = None
 
-class OneTimeTokenizer(Tokenizer):
-    """
-    Wrap the CourtListener tokenizer to save tokenization results.
-    """
-
-    base_tokenizer: Tokenizer
-
-    def __init__(self, base_tokenizer: Tokenizer):
-        self.base_tokenizer = base_tokenizer
-        self.words = []
-        self.cit_toks = []
-
-    def tokenize(self, text: str):
-        if not self.words or self.cit_toks:
-            # some of the static methods in AhocorasickTokenizer don't like children.
-            self.words, self.cit_toks = self.base_tokenizer.tokenize(text)
-        return self.words, self.cit_toks
 
+def _init_worker(network_build_id: str):
+    global _worker_engine, _worker_case_name_index
+    _worker_engine = create_engine(get_db_url())
+    _worker_case_name_index = None
+    try:
+        _worker_case_name_index = CaseNameIndex.load(
+            CASE_NAME_INDEX_PATH, network_build_id=network_build_id
+        )
+    except (OSError, ValueError, KeyError) as err:
+        Logger.error(f"Couldn't load the case name index, every chunk will fail: {err}")
+    get_tokenizer()
 
-class CitationContextScraper:
-    eyecite_tokenizer: Tokenizer
-    reporter_resource_dict: dict
-    process_pool_size: int
-
-    def __init__(self, process_pool_size=1):
-        self.process_pool_size = process_pool_size
 
-    def scrape_contexts(self):
-        Logger.info("Constructing reporter to resource_id dict...")
-        with get_session() as s:
-            self.reporter_resource_dict = self.__get_reporter_resource_dict(s)
+def _populate_db_contexts_for_chunk(
+    resource_id_range: Tuple[int, int]
+) -> Tuple[int, int, float, bool]:
+    """
+    Scrapes the opinions of the scraped jurisdictions with resource IDs in the (inclusive) range, committing their
+    contexts and parentheticals in one transaction. Returns the number of opinions scraped, the number that failed,
+    the seconds it took, and whether the whole chunk failed (and was rolled back, so its opinions all count as failed).
+    """
+    start_time = time.perf_counter()
+    first_id, last_id = resource_id_range
+    opinions = keyset_iterator(
+        _worker_engine,
+        select(Opinion.resource_id, Opinion.html_text)
+        .join(Cluster)
+        .where(Cluster.court.in_(JURISDICTIONS))
+        .where(Opinion.resource_id.between(first_id, last_id)),
+        Opinion.resource_id,
+        batch_size=OPINION_TEXT_BATCH_SIZE,
+    )
+    num_opinions, num_failed, is_failed = 0, 0, False
+    with Session(_worker_engine) as s:
         try:
-            Logger.info("Initializing Hyperscan tokenizer...")
-            # noinspection PyPackageRequirements,PyUnresolvedReferences
-            import hyperscan
+            if _worker_case_name_index is None:
+                raise ValueError("No case name index to resolve citations with")
+            for opinion_id, html_text in opinions:
+                num_opinions += 1
+                try:
+                    _populate_db_contexts_for_opinion(
+                        s, opinion_id, html_text, _worker_case_name_index
+                    )
+                except Exception as e:
+                    Logger.error(f"Failed {opinion_id} with {e}!")
+                    num_failed += 1
+            s.commit()
+        except Exception as e:
+            s.rollback()
+            Logger.error(
+                f"Failed chunk of resource IDs {first_id} to {last_id} with {e}!"
+            )
+            num_failed, is_failed = num_opinions, True
+    return num_opinions, num_failed, time.perf_counter() - start_time, is_failed
 
-            self.eyecite_tokenizer = HyperscanTokenizer(cache_dir=HYPERSCAN_TMP_PATH)
-        except:
-            Logger.info("Failed to initialize hyperscan, using Ahocorasick...")
-            self.eyecite_tokenizer = AhocorasickTokenizer()
-        with Pool(self.process_pool_size) as p:
-            p.map(self.populate_jurisdiction_db_context, JURISDICTIONS)
 
-    def __populate_db_contexts_for_opinion(
-        self,
-        session: Session,
-        opinion: Opinion,
-        reporter_resource_dict: dict,
-        context_slice=slice(-128, 128),
-    ) -> None:
-        unstructured_html = opinion.html_text
-        if not unstructured_html:
-            raise ValueError(f"No HTML for case {opinion.resource_id}")
-        unstructured_text = BeautifulSoup(unstructured_html, features="lxml").text
-        clean_text = unstructured_text.replace("U. S.", "U.S.")
-        tokenizer = OneTimeTokenizer(self.eyecite_tokenizer)
-        citations = list(eyecite.get_citations(clean_text, tokenizer=tokenizer))
-        cited_resources = eyecite.resolve_citations(citations)
-        for resource, citation_list in cited_resources.items():
-            cited_opinion_res_id = reporter_resource_dict.get(
-                format_reporter(
-                    resource.citation.groups.get("volume"),
-                    resource.citation.groups.get("reporter"),
-                    resource.citation.groups.get("page"),
-                )
+def _populate_db_contexts_for_opinion(
+    session: Session,
+    opinion_id: int,
+    unstructured_html: str,
+    case_name_index: CaseNameIndex,
+    context_slice=slice(-128, 128),
+) -> None:
+    if not unstructured_html:
+        raise ValueError(f"No HTML for case {opinion_id}")
+    unstructured_text = BeautifulSoup(unstructured_html, features="lxml").text
+    clean_text = unstructured_text.replace("U. S.", "U.S.")
+    tokenizer = OneTimeTokenizer()
+    citations = list(eyecite.get_citations(clean_text, tokenizer=tokenizer))
+    cited_resources = list(eyecite.resolve_citations(citations).items())
+    cited_cases = case_name_index.cases_of_reporters(
+        [
+            format_reporter(
+                resource.citation.groups.get("volume"),
+                resource.citation.groups.get("reporter"),
+                resource.citation.groups.get("page"),
             )
-            if cited_opinion_res_id is None:
+            for resource, _ in cited_resources
+        ]
+    )
+    for (resource, citation_list), cited_case in zip(cited_resources, cited_cases):
+        if cited_case == -1:
+            continue
+        cited_opinion_res_id = int(case_name_index.opinion_ids[cited_case])
+        for citation in citation_list:
+            if not isinstance(citation, CaseCitation):
                 continue
-            for citation in citation_list:
-                if not isinstance(citation, CaseCitation):
-                    continue
-                if (
-                    citation.metadata.parenthetical is not None
-                    and ParentheticalProcessor.is_descriptive(
-                        citation.metadata.parenthetical
-                    )
-                ):
-                    session.add(
-                        OpinionParenthetical(
-                            citing_opinion_id=opinion.resource_id,
-                            cited_opinion_id=cited_opinion_res_id,
-                            text=ParentheticalProcessor.prepare_text(
-                                citation.metadata.parenthetical
-                            ),
-                        )
-                    )
-                start = max(0, citation.index + context_slice.start)
-                stop = min(len(tokenizer.words), citation.index + context_slice.stop)
+            if (
+                citation.metadata.parenthetical is not None
+                and ParentheticalProcessor.is_descriptive(
+                    citation.metadata.parenthetical
+                )
+            ):
                 session.add(
-                    CitationContext(
-                        citing_opinion_id=opinion.resource_id,
+                    OpinionParenthetical(
+                        citing_opinion_id=opinion_id,
                         cited_opinion_id=cited_opinion_res_id,
-                        text=" ".join(
-                            [
-                                s
-                                for s in tokenizer.words[start:stop]
-                                if isinstance(s, str)
-                            ]
+                        text=ParentheticalProcessor.prepare_text(
+                            citation.metadata.parenthetical
                         ),
                     )
                 )
+            start = max(0, citation.index + context_slice.start)
+            stop = min(len(tokenizer.words), citation.index + context_slice.stop)
+            session.add(
+                CitationContext(
+                    citing_opinion_id=opinion_id,
+                    cited_opinion_id=cited_opinion_res_id,
+                    text=" ".join(
+                        [s for s in tokenizer.words[start:stop] if isinstance(s, str)]
+                    ),
+                )
+            )
+
+
+class CitationContextScraper:
+    """
+    Scrapes citation contexts and parentheticals from the stored texts of the opinions of every jurisdiction in
+    JURISDICTIONS. Opinions are split into chunks of consecutive resource IDs, which are scraped across a process
+    pool in whatever order workers finish them, so that no one large jurisdiction holds up the rest.
+    """
+
+    network_build_id: str
+    process_pool_size: int
+
+    def __init__(self, process_pool_size=1):
+        self.process_pool_size = process_pool_size
 
-    def __get_reporter_resource_dict(self, session: Session):
-        reporter_resource_dict = {}
-        reporter_max_citation_count = defaultdict(lambda: -1)
-        for reporter, resource_id, citation_count in session.execute(
-            select(Cluster.reporter, Opinion.resource_id, Cluster.citation_count).join(
-                Cluster
+    def scrape_contexts(self):
+        # Citations are resolved with the case name index of the cached network, which each worker maps itself.
+        citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+        if citation_network.case_name_index is None:
+            citation_network.build_case_name_index()
+        self.network_build_id = citation_network.network_edge_list.build_id
+        resource_id_ranges = self.__resource_id_ranges()
+        Logger.info(
+            f"Scraping {len(resource_id_ranges)} chunks of opinions with {self.process_pool_size} process(es)..."
+        )
+        # Compile the tokenizer before forking, so that every worker inherits it (and the Hyperscan database is cached).
+        get_tokenizer()
+        if self.process_pool_size > 1:
+            with Pool(
+                self.process_pool_size,
+                initializer=_init_worker,
+                initargs=(self.network_build_id,),
+            ) as p:
+                self.__log_progress(
+                    p.imap_unordered(
+                        _populate_db_contexts_for_chunk, resource_id_ranges
+                    ),
+                    len(resource_id_ranges),
+                )
+        else:
+            _init_worker(self.network_build_id)
+            self.__log_progress(
+                map(_populate_db_contexts_for_chunk, resource_id_ranges),
+                len(resource_id_ranges),
             )
-        ).iterator:
-            if reporter not in reporter_resource_dict:
-                reporter_resource_dict[reporter] = resource_id
-                reporter_max_citation_count[reporter] = citation_count
-            else:
-                if citation_count > reporter_max_citation_count[reporter]:
-                    reporter_resource_dict[reporter] = resource_id
-                    reporter_max_citation_count[reporter] = citation_count
-        return reporter_resource_dict
+        Logger.info("Context scraping complete.")
 
-    def __batched_opinion_iterator(self, session: Session, jur: Court, batch_size=1000):
-        page_no = 0
-        while (
-            opinions := session.execute(
-                select(Opinion)
+    @staticmethod
+    def __resource_id_ranges() -> List[Tuple[int, int]]:
+        """Splits the resource IDs of the opinions to scrape into inclusive ranges of OPINIONS_PER_CHUNK opinions."""
+        resource_ids = [
+            resource_id
+            for (resource_id,) in keyset_iterator(
+                ENGINE,
+                select(Opinion.resource_id)
                 .join(Cluster)
-                .filter(Cluster.court == jur)
-                .limit(batch_size)
-                .offset(page_no * batch_size)
+                .where(Cluster.court.in_(JURISDICTIONS)),
+                Opinion.resource_id,
+                batch_size=100_000,
             )
-            .scalars()
-            .all()
-        ):
-            for op in opinions:
-                yield op
-            page_no += 1
+        ]
+        return [
+            (
+                resource_ids[start],
+                resource_ids[min(start + OPINIONS_PER_CHUNK, len(resource_ids)) - 1],
+            )
+            for start in range(0, len(resource_ids), OPINIONS_PER_CHUNK)
+        ]
 
-    def populate_jurisdiction_db_context(self, jur: Court):
-        s = Session(create_engine(get_db_url()))
-        for i, op in enumerate(self.__batched_opinion_iterator(s, jur)):
-            try:
-                self.__populate_db_contexts_for_opinion(
-                    s, op, self.reporter_resource_dict
-                )
-            except Exception as e:
-                Logger.error(f"Failed {op.resource_id} with {e}!")
-                continue
-            if i > 0 and i % 1000 == 0:
-                s.commit()
-                if i % 10_000 == 0:
-                    Logger.info(f"Completed {i} opinions for jurisdiction {jur}...")
-        s.commit()
+    @staticmethod
+    def __log_progress(chunk_results, num_chunks: int):
+        start_time = time.perf_counter()
+        total_opinions, total_failed, failed_chunks = 0, 0, 0
+        for i, (num_opinions, num_failed, chunk_seconds, is_failed) in enumerate(
+            chunk_results
+        ):
+            total_opinions += num_opinions
+            total_failed += num_failed
+            failed_chunks += is_failed
+            elapsed = time.perf_counter() - start_time
+            Logger.info(
+                f"Chunk {i + 1}/{num_chunks}: {num_opinions} opinions in {chunk_seconds:.1f}s "
+                f"({num_opinions / max(chunk_seconds, 1e-9):.1f}/s). "
+                f"{total_opinions} opinions ({total_failed} failed) in {elapsed:.1f}s "
+                f"({total_opinions / max(elapsed, 1e-9):.1f}/s overall)..."
+            )
+        if failed_chunks:
+            Logger.error(
+                f"{failed_chunks}/{num_chunks} chunks failed and were rolled back; rerun their resource ID ranges."
+            )
 
 
 if __name__ == "__main__":
@@ -4,21 +4,28 @@ from utils.io import get_full_path
 import csv
 
 CITATION_CSV_PATH = "data/citation_list.csv"
+CITATION_BATCH_SIZE = 100_000
 
 
 def create_citations_csv():
-    with get_session() as s:
-        citations = s.execute(
-            select(
-                Citation.citing_opinion_id, Citation.cited_opinion_id, Citation.depth
-            )
-        ).all()
-    print("Fetched citations, writing to file...")
+    # Citations are written as they are streamed rather than loaded into memory first.
+    citations = keyset_iterator(
+        ENGINE,
+        select(
+            Citation.id,
+            Citation.citing_opinion_id,
+            Citation.cited_opinion_id,
+            Citation.depth,
+        ),
+        Citation.id,
+        batch_size=CITATION_BATCH_SIZE,
+    )
+    print("Streaming citations to file...")
     with open(get_full_path(CITATION_CSV_PATH), "w", 1024 * 1024) as citation_file:
         csv_writer = csv.writer(citation_file)
         i = 0
-        for citation in citations:
-            csv_writer.writerow(citation)
+        for _, citing_opinion_id, cited_opinion_id, depth in citations:
+            csv_writer.writerow((citing_opinion_id, cited_opinion_id, depth))
             if i != 0 and i % 1000000 == 0:
                 print(f"Completed {i} rows...")
             i += 1
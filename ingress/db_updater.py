@@ -184,15 +184,20 @@ class DbUpdater:
     def process_citation_data(self, citations_file):
         opinion_checksum_dict = self.__get_opinion_checksum_dict()
         # Big memory drinker, but worth it for the speed increase unless it becomes a problem.
-        citation_set = set(
-            self.session.execute(
+        citation_set = {
+            (citing_opinion_id, cited_opinion_id, depth)
+            for _, citing_opinion_id, cited_opinion_id, depth in keyset_iterator(
+                ENGINE,
                 select(
+                    Citation.id,
                     Citation.citing_opinion_id,
                     Citation.cited_opinion_id,
                     Citation.depth,
-                )
-            ).all()
-        )
+                ),
+                Citation.id,
+                batch_size=100_000,
+            )
+        }
 
         citation_records = []
         with open(citations_file) as csv_file:
@@ -298,15 +303,21 @@ class DbUpdater:
         self.session.execute(query)
 
     def __get_cluster_checksum_dict(self) -> Dict[int, str]:
-        res = self.session.execute(
-            select(Cluster.resource_id, Cluster.courtlistener_json_checksum)
-        ).all()
+        res = keyset_iterator(
+            ENGINE,
+            select(Cluster.resource_id, Cluster.courtlistener_json_checksum),
+            Cluster.resource_id,
+            batch_size=DEFAULT_BATCH_SIZE,
+        )
         return {resource_id: checksum for resource_id, checksum in res}
 
     def __get_opinion_checksum_dict(self) -> Dict[int, str]:
-        res = self.session.execute(
-            select(Opinion.resource_id, Opinion.courtlistener_json_checksum)
-        ).all()
+        res = keyset_iterator(
+            ENGINE,
+            select(Opinion.resource_id, Opinion.courtlistener_json_checksum),
+            Opinion.resource_id,
+            batch_size=DEFAULT_BATCH_SIZE,
+        )
         return {resource_id: checksum for resource_id, checksum in res}
 
 
@@ -0,0 +1,279 @@
+import json
+import os
+from multiprocessing import Pool
+from typing import List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func, select, text
+
+from algorithms.case_similarity import CaseSimilarity
+from db.sqlalchemy import ENGINE, get_session
+from db.sqlalchemy.models import Similarity
+from graph import CitationNetwork
+from graph.network_edge_list import NetworkEdgeList
+from utils.io import NETWORK_CACHE_PATH, SIMILARITY_EXPORT_PATH
+from utils.logger import Logger
+
+DEFAULT_TOP_K = 100
+# Chunks are sized so that the sparse Jaccard product of each has at most about this many entries
+MAX_PRODUCT_NNZ_PER_CHUNK = 5_000_000
+COPY_SIMILARITY_SQL = "COPY similarity (opinion_a_id, opinion_b_id, similarity_index) FROM STDIN WITH (FORMAT binary)"
+# PostgreSQL's binary COPY format: a signature, flags and header extension length, then for each row the number of
+# fields and each field's length and big-endian value, then a -1 field count to end the data.
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + np.zeros(2, dtype=">i4").tobytes()
+COPY_BINARY_TRAILER = np.array([-1], dtype=">i2").tobytes()
+COPY_ROW_DTYPE = np.dtype(
+    [
+        ("num_fields", ">i2"),
+        ("opinion_a_id_length", ">i4"),
+        ("opinion_a_id", ">i8"),
+        ("opinion_b_id_length", ">i4"),
+        ("opinion_b_id", ">i8"),
+        ("similarity_index_length", ">i4"),
+        ("similarity_index", ">f8"),
+    ]
+)
+COPY_READ_SIZE = 1 << 20
+
+# Per-process similarity engine, set up once by _init_worker so that each pool process maps the network once.
+# Pool workers memory-map the network cache themselves and are left without an engine if it isn't the parent's build.
+_worker_similarity: Optional[CaseSimilarity] = None
+_worker_top_k: Optional[int] = None
+_worker_two_hop = False
+
+
+def _init_worker(
+    top_k: Optional[int],
+    two_hop: bool,
+    network_build_id: str,
+    citation_network: CitationNetwork = None,
+):
+    global _worker_similarity, _worker_top_k, _worker_two_hop
+    _worker_top_k = top_k
+    _worker_two_hop = two_hop
+    if citation_network is None:
+        try:
+            edge_list = NetworkEdgeList.load(NETWORK_CACHE_PATH)
+        except (OSError, ValueError, KeyError) as err:
+            Logger.error(f"Similarity worker could not load the network cache: {err}")
+            return
+        if edge_list.build_id != network_build_id:
+            Logger.error(
+                f"Similarity worker found network build {edge_list.build_id} instead of {network_build_id}"
+            )
+            return
+        citation_network = CitationNetwork(network_edge_list=edge_list)
+    _worker_similarity = CaseSimilarity(citation_network)
+
+
+def _similarity_rows_for_chunk(node_range: Tuple[int, int]) -> Tuple[int, bytes]:
+    """
+    Computes the Jaccard similarity of each node in the range to each of its neighbors (or with two_hop, to every
+    node it shares a neighbor with), and returns the number of rows along with the rows themselves in PostgreSQL's
+    binary COPY format, without the header and trailer.
+    """
+    if _worker_similarity is None:
+        raise ValueError(
+            "Similarity worker has no network matching the exported network."
+        )
+    edge_list = _worker_similarity.citation_network.network_edge_list
+    node_indices = np.arange(*node_range)
+    similarities = (
+        _worker_similarity.jaccard_similarities(node_indices)
+        if _worker_two_hop
+        else _worker_similarity.neighbor_similarities(node_indices)
+    ).tocoo()
+    rows, cols, values = similarities.row, similarities.col, similarities.data
+    not_self = node_indices[rows] != cols
+    rows, cols, values = rows[not_self], cols[not_self], values[not_self]
+    if _worker_top_k is not None:
+        # Rank each row's entries by descending similarity and keep the first top_k of each row.
+        order = np.lexsort((-values, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        row_starts = np.searchsorted(rows, rows, side="left")
+        keep = np.arange(len(rows)) - row_starts < _worker_top_k
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+    copy_rows = np.empty(len(rows), dtype=COPY_ROW_DTYPE)
+    copy_rows["num_fields"] = 3
+    copy_rows["opinion_a_id_length"] = 8
+    copy_rows["opinion_a_id"] = edge_list.opinion_ids_of(node_indices[rows])
+    copy_rows["opinion_b_id_length"] = 8
+    copy_rows["opinion_b_id"] = edge_list.opinion_ids_of(cols)
+    copy_rows["similarity_index_length"] = 8
+    copy_rows["similarity_index"] = values
+    return len(rows), copy_rows.tobytes()
+
+
+class _BinaryCopyReader:
+    """
+    File-like object that hands COPY the rows of a chunk between the binary header and trailer, one piece at a
+    time, rather than concatenating them into another buffer.
+    """
+
+    def __init__(self, rows: bytes):
+        self.__pieces = [
+            memoryview(COPY_BINARY_HEADER),
+            memoryview(rows),
+            memoryview(COPY_BINARY_TRAILER),
+        ]
+
+    def read(self, size=COPY_READ_SIZE) -> bytes:
+        while self.__pieces and len(self.__pieces[0]) == 0:
+            self.__pieces.pop(0)
+        if not self.__pieces:
+            return b""
+        piece = self.__pieces[0]
+        if size is None or size < 0:
+            size = len(piece)
+        self.__pieces[0] = piece[size:]
+        return piece[:size].tobytes()
+
+
+class SimilarityExporter:
+    """
+    Fills the similarity table with the neighbor Jaccard similarity of every opinion to the top_k most similar of
+    the opinions it cites or is cited by (or with two_hop, of every opinion it shares a citation neighbor with).
+    Chunks of opinions, sized by how large their sparse Jaccard product is, are scored across a process pool and
+    streamed into the table with binary COPY, one transaction per chunk.
+
+    Chunks are processed in resource_id order, so an interrupted export can resume after the largest opinion_a_id
+    already in the table. Each export records the network build and settings it was started with in
+    SIMILARITY_EXPORT_PATH, and only an export of the same build with the same settings is resumed.
+    """
+
+    top_k: Optional[int]
+    two_hop: bool
+    pool_size: int
+    resume: bool
+
+    def __init__(
+        self,
+        top_k: Optional[int] = DEFAULT_TOP_K,
+        two_hop=False,
+        pool_size=1,
+        resume=False,
+    ):
+        """
+        :param top_k: How many similar opinions to store for each opinion, or None to store every nonzero
+        similarity (which with two_hop can be billions of rows)
+        :param resume: Whether to continue an interrupted export rather than clearing the table and starting over
+        """
+        self.top_k = top_k
+        self.two_hop = two_hop
+        self.pool_size = pool_size
+        self.resume = resume
+
+    def export(self):
+        citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+        edge_list = citation_network.network_edge_list
+        start_idx = self.__start_index(citation_network)
+        node_ranges = self.__node_ranges(citation_network, start_idx)
+        Logger.info(
+            f"Exporting similarities for {edge_list.num_nodes - start_idx} opinions with {self.pool_size} process(es)..."
+        )
+        if self.pool_size > 1:
+            # Workers memory-map the network cache themselves rather than receiving a pickled copy of it.
+            with Pool(
+                self.pool_size,
+                initializer=_init_worker,
+                initargs=(self.top_k, self.two_hop, edge_list.build_id),
+            ) as p:
+                self.__copy_chunks(
+                    p.imap(_similarity_rows_for_chunk, node_ranges), node_ranges
+                )
+        else:
+            _init_worker(self.top_k, self.two_hop, edge_list.build_id, citation_network)
+            self.__copy_chunks(
+                map(_similarity_rows_for_chunk, node_ranges), node_ranges
+            )
+        Logger.info("Similarity export complete.")
+
+    @staticmethod
+    def __node_ranges(
+        citation_network: CitationNetwork, start_idx: int
+    ) -> List[Tuple[int, int]]:
+        """
+        Splits the nodes from start_idx on into consecutive ranges whose Jaccard products have at most about
+        MAX_PRODUCT_NNZ_PER_CHUNK entries (or a single node, if that alone has more). The product row of a node has
+        at most as many entries as its neighbors have neighbors, so that sum bounds the size of each chunk.
+        """
+        adjacency_matrix = citation_network.adjacency_matrix
+        degrees = np.diff(adjacency_matrix.indptr)
+        product_nnz_bounds = adjacency_matrix @ degrees.astype("float64")
+        cumulative_nnz = np.concatenate(([0], np.cumsum(product_nnz_bounds)))
+        num_nodes = citation_network.network_edge_list.num_nodes
+        node_ranges = []
+        start = start_idx
+        while start < num_nodes:
+            end = int(
+                np.searchsorted(
+                    cumulative_nnz,
+                    cumulative_nnz[start] + MAX_PRODUCT_NNZ_PER_CHUNK,
+                    side="right",
+                )
+            )
+            end = min(max(end - 1, start + 1), num_nodes)
+            node_ranges.append((start, end))
+            start = end
+        return node_ranges
+
+    def __start_index(self, citation_network: CitationNetwork) -> int:
+        export_settings = {
+            "network_build_id": citation_network.network_edge_list.build_id,
+            "top_k": self.top_k,
+            "two_hop": self.two_hop,
+        }
+        if not self.resume:
+            Logger.info("Clearing similarity table...")
+            with get_session() as s:
+                s.execute(text("TRUNCATE similarity"))
+                s.commit()
+            tmp_path = f"{SIMILARITY_EXPORT_PATH}.tmp-{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(export_settings, f)
+            os.replace(tmp_path, SIMILARITY_EXPORT_PATH)
+            return 0
+        try:
+            with open(SIMILARITY_EXPORT_PATH) as f:
+                started_export_settings = json.load(f)
+        except FileNotFoundError:
+            raise ValueError(
+                "The similarity table wasn't filled by a recorded export, so it can't be resumed"
+            )
+        if started_export_settings != export_settings:
+            raise ValueError(
+                f"Can't resume an export started with {started_export_settings} as {export_settings}"
+            )
+        with get_session() as s:
+            last_opinion_id = s.execute(
+                select(func.max(Similarity.opinion_a_id))
+            ).scalar()
+        if last_opinion_id is None:
+            return 0
+        Logger.info(f"Resuming similarity export after opinion {last_opinion_id}...")
+        return int(
+            np.searchsorted(
+                citation_network.network_edge_list.node_ids,
+                last_opinion_id,
+                side="right",
+            )
+        )
+
+    @staticmethod
+    def __copy_chunks(chunk_rows, node_ranges):
+        connection = ENGINE.raw_connection()
+        try:
+            num_rows = 0
+            for i, (chunk_num_rows, rows) in enumerate(chunk_rows):
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(
+                        COPY_SIMILARITY_SQL, _BinaryCopyReader(rows), COPY_READ_SIZE
+                    )
+                connection.commit()
+                num_rows += chunk_num_rows
+                if (i + 1) % 10 == 0:
+                    Logger.info(
+                        f"Copied {num_rows} similarities for opinions through index {node_ranges[i][1]}..."
+                    )
+        finally:
+            connection.close()
@@ -0,0 +1,137 @@
+from multiprocessing import Pool
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from algorithms.case_recommendation import (
+    CaseRecommendation,
+    MAX_NUM_STEPS,
+    MAX_WALK_LENGTH,
+)
+from graph import CitationNetwork
+from graph.network_edge_list import NetworkEdgeList
+from graph.walk_vector_store import WalkVectorStoreWriter
+from utils.io import NETWORK_CACHE_PATH
+from utils.logger import Logger
+
+DEFAULT_TOP_K = 100
+NODES_PER_CHUNK = 1_000
+# Stored walks stop early like query-time walks do by default; queries that turn early stopping off always walk.
+EARLY_STOPPING = True
+
+# Per-process recommendation engine, set up once by _init_worker so that each pool process maps the network once.
+# Pool workers memory-map the network cache themselves and are left without an engine if it isn't the parent's build.
+_worker_recommendation: Optional[CaseRecommendation] = None
+_worker_top_k: int = DEFAULT_TOP_K
+_worker_seed: int = 0
+
+
+def _init_worker(
+    top_k: int,
+    seed: int,
+    network_build_id: str,
+    citation_network: CitationNetwork = None,
+):
+    global _worker_recommendation, _worker_top_k, _worker_seed
+    _worker_top_k = top_k
+    _worker_seed = seed
+    if citation_network is None:
+        try:
+            edge_list = NetworkEdgeList.load(NETWORK_CACHE_PATH)
+        except (OSError, ValueError, KeyError) as err:
+            Logger.error(f"Walk vector worker could not load the network cache: {err}")
+            return
+        if edge_list.build_id != network_build_id:
+            Logger.error(
+                f"Walk vector worker found network build {edge_list.build_id} instead of {network_build_id}"
+            )
+            return
+        citation_network = CitationNetwork(network_edge_list=edge_list)
+    _worker_recommendation = CaseRecommendation(citation_network)
+
+
+def _walk_vectors_for_chunk(
+    node_range: Tuple[int, int]
+) -> List[Tuple[np.array, np.array, int]]:
+    if _worker_recommendation is None:
+        raise ValueError(
+            "Walk vector worker has no network matching the network being precomputed."
+        )
+    vectors = []
+    for node_idx in range(*node_range):
+        case_walk = _worker_recommendation.walk_visit_counts(
+            node_idx,
+            max_walk_length=MAX_WALK_LENGTH,
+            max_num_steps=MAX_NUM_STEPS,
+            early_stopping=EARLY_STOPPING,
+            rng=np.random.default_rng([_worker_seed, node_idx]),
+        )
+        nodes, visit_counts = case_walk.nodes, case_walk.visit_counts
+        if len(nodes) > _worker_top_k:
+            top = np.argpartition(-visit_counts, _worker_top_k)[:_worker_top_k]
+            top.sort()
+            nodes, visit_counts = nodes[top], visit_counts[top]
+        vectors.append((nodes, visit_counts, case_walk.num_steps))
+    return vectors
+
+
+class WalkVectorPrecomputer:
+    """
+    Offline job that walks from every opinion in the cached citation network and stores the top_k most visited
+    nodes of each, so that rwalk recommendations can merge stored vectors instead of walking at query time.
+    """
+
+    output_path: str
+    top_k: int
+    pool_size: int
+    seed: int
+
+    def __init__(self, output_path: str, top_k=DEFAULT_TOP_K, pool_size=1, seed=0):
+        self.output_path = output_path
+        self.top_k = top_k
+        self.pool_size = pool_size
+        self.seed = seed
+
+    def precompute(self):
+        citation_network = CitationNetwork.get_citation_network(enable_caching=True)
+        edge_list = citation_network.network_edge_list
+        writer = WalkVectorStoreWriter(
+            self.output_path,
+            network_build_id=edge_list.build_id,
+            top_k=self.top_k,
+            max_walk_length=MAX_WALK_LENGTH,
+            early_stopping=EARLY_STOPPING,
+        )
+        node_ranges = [
+            (start, min(start + NODES_PER_CHUNK, edge_list.num_nodes))
+            for start in range(0, edge_list.num_nodes, NODES_PER_CHUNK)
+        ]
+        Logger.info(
+            f"Precomputing walk vectors for {edge_list.num_nodes} opinions with {self.pool_size} process(es)..."
+        )
+        if self.pool_size > 1:
+            # Workers memory-map the network cache themselves rather than receiving a pickled copy of it.
+            with Pool(
+                self.pool_size,
+                initializer=_init_worker,
+                initargs=(self.top_k, self.seed, edge_list.build_id),
+            ) as p:
+                self.__write_chunks(
+                    writer, p.imap(_walk_vectors_for_chunk, node_ranges), node_ranges
+                )
+        else:
+            _init_worker(self.top_k, self.seed, edge_list.build_id, citation_network)
+            self.__write_chunks(
+                writer, map(_walk_vectors_for_chunk, node_ranges), node_ranges
+            )
+        writer.close()
+        Logger.info(f"Saved walk vectors to {self.output_path}")
+
+    def __write_chunks(self, writer: WalkVectorStoreWriter, chunk_vectors, node_ranges):
+        for i, vectors in enumerate(chunk_vectors):
+            for nodes, visit_counts, num_steps in vectors:
+                writer.append(nodes, visit_counts, num_steps)
+            if (i + 1) % 10 == 0:
+                Logger.info(
+                    f"Completed walk vectors for {node_ranges[i][1]} opinions..."
+                )
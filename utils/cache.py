@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from utils.logger import Logger
+
+_MISSING = object()
+
+
+class LruTtlCache:
+    """
+    A thread-safe, size-bounded LRU cache whose entries also expire after ttl seconds.
+    """
+
+    max_size: int
+    ttl: float
+    hits: int
+    misses: int
+
+    def __init__(self, max_size=1024, ttl=3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if time.monotonic() < expires_at:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.__entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value) -> None:
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+class DiskCache:
+    """
+    A JSON file cache that can be shared by every process on a machine. Entries live in a subdirectory named after
+    a version string (e.g. the build ID of the network they were computed from), and subdirectories of other
+    versions are deleted when the cache is opened, so entries never outlive the data they were derived from.
+    """
+
+    directory: str
+    ttl: float
+    hits: int
+    misses: int
+
+    def __init__(self, base_directory: str, version: str, ttl=86400.0):
+        self.directory = os.path.join(base_directory, version)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        for entry in os.listdir(base_directory):
+            if entry != version:
+                shutil.rmtree(os.path.join(base_directory, entry), ignore_errors=True)
+
+    def get(self, key: Hashable, default=None):
+        path = self.__entry_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) < self.ttl:
+                with open(path) as f:
+                    value = json.load(f)
+                self.hits += 1
+                return value
+            os.remove(path)
+        except (OSError, ValueError):
+            pass
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value) -> None:
+        path = self.__entry_path(key)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            Logger.warning(f"Failed to write disk cache entry {path}: {err}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "directory": self.directory,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+    def __entry_path(self, key: Hashable) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + ".json"
+        )
+
+
+class ResultCache:
+    """
+    An in-process LruTtlCache, optionally backed by a DiskCache shared between processes. Values must be
+    JSON-serializable if a disk cache is used.
+    """
+
+    memory: LruTtlCache
+    disk: Optional[DiskCache]
+
+    def __init__(self, memory: LruTtlCache, disk: DiskCache = None):
+        self.memory = memory
+        self.disk = disk
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]):
+        if (value := self.memory.get(key, _MISSING)) is not _MISSING:
+            return value
+        if self.disk is not None:
+            if (value := self.disk.get(key, _MISSING)) is not _MISSING:
+                self.memory.set(key, value)
+                return value
+        value = compute()
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory": self.memory.stats(),
+            "disk": self.disk.stats() if self.disk is not None else None,
+        }
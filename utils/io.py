@@ -9,6 +9,15 @@ def get_full_path(relative_project_path):
 
 
 N2V_MODEL_PATH = get_full_path("tmp/n2v_gensim.bin")
+N2V_EMBEDDINGS_PATH = get_full_path("tmp/n2v_embeddings")
+N2V_ANN_INDEX_PATH = get_full_path("tmp/n2v_ann_index")
 CITATION_LIST_CSV_PATH = get_full_path("tmp/citation_list.csv")
-NETWORK_CACHE_PATH = get_full_path("tmp/network_cache.pik")
+NETWORK_CACHE_PATH = get_full_path("tmp/network_cache")
+WALK_VECTORS_PATH = get_full_path("tmp/walk_vectors")
+MINHASH_INDEX_PATH = get_full_path("tmp/minhash_index")
+CASE_NAME_INDEX_PATH = get_full_path("tmp/case_name_index")
+RECOMMENDATION_CACHE_PATH = get_full_path("tmp/recommendation_cache")
+SIMILARITY_CACHE_PATH = get_full_path("tmp/similarity_cache")
+SIMILARITY_EXPORT_PATH = get_full_path("tmp/similarity_export.json")
 HYPERSCAN_TMP_PATH = get_full_path("tmp/hyperscan")
+PDF_JOBS_PATH = get_full_path("tmp/pdf_jobs.sqlite3")